@@ -1,25 +1,45 @@
 import csv
+import hashlib
 import logging
 import os
 import time
+from collections import Counter
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
 from enum import Enum, auto
-from typing import Union
+from typing import Optional, Union
 
+import numpy as np
 import pandas as pd
 import colorama as color
-from thefuzz import fuzz, process
 
 import util.cli as cli
 import util.file_parsing as fp
+from util.address_index import CEP_STREETS, SIDE_SCALE, AddressIndex, side_keys
+from util.config import default_input_dict
+from util.coordinate_index import (
+    CoordinateIndex,
+    parse_coordinates,
+    project_coordinates,
+)
+from util.result_cache import ResultCache
+from util.street_matcher import StreetMatcher
 from util.street_names import standardize_street_names
 
 
 MAX_ADDRESS_DELTA = 100
+RESULT_VERSION = 3  # Changes when the same lookup may give another result
+CHUNK_SIZE = 10000  # Rows read from the input file at a time
+CHUNKS_PER_WORKER = 2  # Chunks submitted ahead to each worker process
 FUZZ_CUTOFF = 90
-fuzz_cache = {}
 ABSOLUTE_PATH = os.path.dirname(__file__)
 OUTPUT_FOLDER = os.path.join(ABSOLUTE_PATH, "resultado")
 OUTPUT_ENCODING = "cp1252"
+OUTPUT_BUFFER_SIZE = 2**20
 SPINNER_STOP_SYMBOL = color.Fore.GREEN + "  v" + color.Fore.RESET
 logging.getLogger().setLevel(logging.ERROR)
 
@@ -35,12 +55,84 @@ output_columns = [
 ]
 
 
+# Keys of the results of geocode()
+result_columns = [
+    "REGIONAL",
+    "AA",
+    "QT",
+    "CEP",
+    "COD_LOGR",
+    "TIPOLOGR",
+    "NOMELOGR",
+    "NUM_IMOV",
+    "BAIRRO",
+    "X",
+    "Y",
+    "LOG_LGRD",
+    "LOG_NUMR",
+]
+# Columns added by the reverse geocoding, DISTANCIA in meters
+reverse_output_columns = [
+    "REGIONAL",
+    "AA",
+    "QT",
+    "BAIRRO",
+    "CEP",
+    "COD_LOGR",
+    "TIPOLOGR",
+    "NOMELOGR",
+    "NUM_IMOV",
+    "DISTANCIA",
+]
+worker_context = {}
+result_not_found = {
+    "REGIONAL": "",
+    "AA": "",
+    "QT": "",
+    "BAIRRO": "",
+    "X": "",
+    "Y": "",
+    "LOG_LGRD": "Não localizado",
+    "LOG_NUMR": "Não localizado",
+}
+
+
 class SearchMode(Enum):
     BY_CODE = auto()
     BY_CEP = auto()
     BY_NAME = auto()
 
 
+street_keys = {
+    SearchMode.BY_CODE: "COD_LOGR",
+    SearchMode.BY_CEP: "CEP",
+    SearchMode.BY_NAME: "NOMELOGR",
+}
+street_found_logs = {
+    SearchMode.BY_CODE: "Loc. pelo código",
+    SearchMode.BY_CEP: "Loc. pelo CEP",
+    SearchMode.BY_NAME: "Loc. pelo nome",
+}
+# Keys of the default columns in config_entrada.yaml
+default_street_columns = {
+    SearchMode.BY_CODE: "codigo_logradouro",
+    SearchMode.BY_CEP: "cep",
+    SearchMode.BY_NAME: "nome_logradouro",
+}
+
+
+def text_value(value) -> str:
+    """
+    Input value as text: blank if it is missing, and without the ".0" that pandas
+    gives to the integers of columns with missing values
+    """
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
 def clean_number(text: str) -> int:
     clean_text = [char for char in text if char.isdigit()]
     if len(clean_text) == 0:
@@ -48,22 +140,129 @@ def clean_number(text: str) -> int:
     return int("".join(clean_text))
 
 
-def join_result(row: dict[str, str], geocode_result: dict[str, str]) -> list[str]:
-    left_side = {}
-    right_side = {}
-    for key, value in row.items():
-        if key not in output_columns:
-            left_side[key] = value
-    for key, value in geocode_result.items():
-        if key in output_columns:
-            right_side[key] = value
-    merge = left_side | right_side
-    return list(merge.values())
+def search_columns(
+    street_columns: dict[SearchMode, str],
+    col_address_number: Optional[str] = None,
+    input_columns: Optional[list[str]] = None,
+) -> tuple[list[tuple[SearchMode, str]], str]:
+    """
+    Search order and address number column for the columns given. Without any
+    street column, the default ones that are in input_columns (if known) are used.
+    Raises ValueError if columns are missing
+    """
+    default_cols = default_input_dict()
+    if not street_columns:
+        street_columns = {
+            mode: default_cols[key]
+            for mode, key in default_street_columns.items()
+            if input_columns is None or default_cols[key] in input_columns
+        }
+        required_cols = []
+    else:
+        required_cols = list(street_columns.values())
+    col_address_number = col_address_number or default_cols["numero_imovel"]
+    if input_columns is not None:
+        missing_cols = [
+            col
+            for col in required_cols + [col_address_number]
+            if col not in input_columns
+        ]
+        if missing_cols:
+            raise ValueError(f"Colunas ausentes: {', '.join(missing_cols)}")
+    if not street_columns:
+        raise ValueError("Nenhuma coluna de código, CEP ou nome do logradouro")
+    search_order = [
+        (mode, street_columns[mode]) for mode in SearchMode if mode in street_columns
+    ]
+    return search_order, col_address_number
+
+
+def lookup_key(
+    search_mode: SearchMode, street: str, address_number: str
+) -> tuple[str, str, int]:
+    """
+    What the result of geocode() depends on: the search mode, the cleaned street
+    code or CEP (or the standardized street name) and the cleaned address number.
+    Missing values (such as those of short CSV rows) are blank
+    """
+    street, address_number = text_value(street), text_value(address_number)
+    if search_mode == SearchMode.BY_NAME:
+        street_key = standardize_street_names(street)
+    else:
+        street_key = str(clean_number(street))
+    return search_mode.name, street_key, clean_number(address_number)
+
+
+def result_version(address_index: AddressIndex, street_matcher: StreetMatcher) -> str:
+    """
+    Version of the results of geocode(), for the ResultCache: they change with the
+    address data and its area polygons, the fuzzy matching settings, the
+    interpolation limit and the way addresses are located
+    """
+    return hashlib.sha1(
+        "\n".join(
+            [
+                str(RESULT_VERSION),
+                address_index.fingerprint,
+                "" if address_index.areas is None else address_index.areas.fingerprint,
+                street_matcher.fingerprint,
+                str(MAX_ADDRESS_DELTA),
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def join_results(
+    rows: list[dict[str, str]],
+    geocode_results: list[dict[str, str]],
+    input_columns: list[str],
+) -> list[list[str]]:
+    """
+    Output lines: the input columns (except output_columns) followed by output_columns
+    """
+    return [
+        [row[col] for col in input_columns] + [result[col] for col in output_columns]
+        for row, result in zip(rows, geocode_results)
+    ]
+
+
+def match_street_name(street_matcher: StreetMatcher, street_name: str) -> Optional[str]:
+    """
+    Fuzzy matches a street name against the standardized names in the address database
+    """
+    return street_matcher.match(standardize_street_names(street_name))
+
+
+def match_street_names(street_matcher: StreetMatcher, street_names) -> None:
+    """
+    Fuzzy matches many street names in a single batch, so that the following
+    calls to match_street_name() are answered by the cache
+    """
+    street_matcher.match_many(
+        [standardize_street_names(name) for name in dict.fromkeys(street_names)]
+    )
+
+
+def get_closest_neighbours(
+    address_index: AddressIndex, address_number: int, street_selection: np.ndarray
+) -> np.ndarray:
+    """
+    Rows of the (up to) two closest addresses on the same side of the street
+    """
+    # Rows in table order, so ties between neighbours are broken by table order
+    street_selection = np.sort(street_selection)
+    street_numbers = address_index.columns["NUM_IMOV"][street_selection]
+    odd_even = 0 if address_number % 2 == 0 else 1
+    same_side_of_street = street_selection[street_numbers % 2 == odd_even]
+    same_side_numbers = street_numbers[street_numbers % 2 == odd_even]
+    return same_side_of_street[
+        np.argsort(np.abs(same_side_numbers - address_number), kind="stable")[:2]
+    ]
 
 
 def geocode(
-    address_data: pd.DataFrame,
-    street_list: list[str],
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
     street: str,
     address_number: str,
     search_mode: SearchMode,
@@ -83,72 +282,46 @@ def geocode(
         "LOG_LGRD": ["Não localizado"],
         "LOG_NUMR": ["Não localizado"],
     }
-
-    def select_street_by_code(street_code: str) -> pd.DataFrame:
-        return address_data[address_data["COD_LOGR"] == clean_number(street_code)]
-
-    def select_street_by_cep(street_cep: str) -> pd.DataFrame:
-        return address_data[address_data["CEP"] == clean_number(street_cep)]
-
-    def select_street_by_name(street_name: str) -> pd.DataFrame:
-        if street_name in fuzz_cache:
-            street_match = fuzz_cache[street_name]
-        else:
-            street_match = process.extractOne(
-                standardize_street_names(street_name),
-                street_list,
-                scorer=fuzz.token_sort_ratio,
-                score_cutoff=FUZZ_CUTOFF,
-            )
-            if street_match is None:
-                return pd.DataFrame(columns=address_data.columns)
-            street_match = street_match[0]
-        fuzz_cache[street_name] = street_match
-        return address_data[address_data["NOMELOGR"] == street_match]
-
-    def get_closest_neighbours(
-        address_number: int, street_selection: pd.DataFrame
-    ) -> pd.DataFrame:
-        odd_even = 0 if address_number % 2 == 0 else 1
-        same_side_of_street = street_selection.loc[
-            street_selection["NUM_IMOV"].mod(2).eq(odd_even), :
-        ]
-        return same_side_of_street.iloc[
-            (same_side_of_street["NUM_IMOV"] - address_number).abs().argsort().iloc[:2]
-        ]
+    address_columns = address_index.columns
 
     def linear_regression(
-        address_number: int, neighbours: pd.DataFrame
+        address_number: int, neighbours: np.ndarray
     ) -> dict[str, str]:
         # Assumes that the address data is sorted, which it is
-        address_smaller = neighbours.iloc[0, :]
-        address_bigger = neighbours.iloc[1, :]
+        address_smaller, address_bigger = neighbours[0], neighbours[1]
+        numbers, x, y = (address_columns[col] for col in ["NUM_IMOV", "X", "Y"])
 
-        delta_neighbours = float(
-            address_bigger["NUM_IMOV"] - address_smaller["NUM_IMOV"]
-        )
+        delta_neighbours = float(numbers[address_bigger] - numbers[address_smaller])
         if delta_neighbours == 0.0:
             return {"X": "", "Y": ""}
-        delta_x = float(address_bigger["X"] - address_smaller["X"])
-        delta_y = float(address_bigger["Y"] - address_smaller["Y"])
+        delta_x = float(x[address_bigger] - x[address_smaller])
+        delta_y = float(y[address_bigger] - y[address_smaller])
         slope_x = delta_x / delta_neighbours
         slope_y = delta_y / delta_neighbours
-        delta_address = float(address_number - address_smaller["NUM_IMOV"])
-        x_float = float(address_smaller["X"]) + (delta_address * slope_x)
-        y_float = float(address_smaller["Y"]) + (delta_address * slope_y)
+        delta_address = float(address_number - numbers[address_smaller])
+        x_float = float(x[address_smaller]) + (delta_address * slope_x)
+        y_float = float(y[address_smaller]) + (delta_address * slope_y)
         x_str = str(int(round(x_float, 0)))
         y_str = str(int(round(y_float, 0)))
         return {"X": x_str, "Y": y_str}
 
     def interpolate_position() -> dict[str, str]:
-        closest_neighbours = get_closest_neighbours(address_number, street_selection)
+        # Numbers too large for the address data are still too far from it
+        search_number = min(address_number, SIDE_SCALE - 1)
+        closest_neighbours = get_interpolation_neighbours(
+            address_index,
+            key,
+            address_index.groups(key, [identifier]),
+            np.array([search_number]),
+        )[0]
 
-        if any(
-            abs(closest_neighbours["NUM_IMOV"] - address_number) > MAX_ADDRESS_DELTA
-        ):
+        if (closest_neighbours < 0).any():
             return result
 
-        if len(closest_neighbours) < 2:
+        if any(
+            abs(address_columns["NUM_IMOV"][closest_neighbours] - search_number)
+            > MAX_ADDRESS_DELTA
+        ):
             return result
         result["NUM_IMOV"] = [address_number]
 
@@ -162,53 +335,472 @@ def geocode(
             "NOMELOGR",
             "BAIRRO",
         ]:
-            if closest_neighbours.iloc[0, :][col] == closest_neighbours.iloc[1, :][col]:
-                result[col] = [closest_neighbours.iloc[0, :][col]]
+            values = address_columns[col][closest_neighbours]
+            if values[0] == values[1]:
+                result[col] = [values[0]]
             else:
                 result[col] = ["Indeterminado"]
 
         coordinates = linear_regression(address_number, closest_neighbours)
         result["X"], result["Y"] = [coordinates["X"]], [coordinates["Y"]]
+        if address_index.areas is not None and coordinates["X"] != "":
+            areas = address_index.areas.lookup(
+                [float(coordinates["X"])], [float(coordinates["Y"])]
+            )
+            for col, values in areas.items():
+                if values[0] is not None:
+                    result[col] = [values[0]]
         result["LOG_NUMR"] = ["End. aproximado"]
         return result
 
-    if search_mode == SearchMode.BY_CODE:
-        street_selection = select_street_by_code(street)
-        if len(street_selection) > 0:
-            result["LOG_LGRD"] = ["Loc. pelo código"]
-    if search_mode == SearchMode.BY_CEP:
-        street_selection = select_street_by_cep(street)
-        if len(street_selection) > 0:
-            result["LOG_LGRD"] = ["Loc. pelo CEP"]
+    key = street_keys[search_mode]
+    street, address_number = text_value(street), text_value(address_number)
     if search_mode == SearchMode.BY_NAME:
-        street_selection = select_street_by_name(street)
-        if len(street_selection) > 0:
-            result["LOG_LGRD"] = ["Loc. pelo nome"]
+        identifier = match_street_name(street_matcher, street)
+    else:
+        identifier = clean_number(street)
+    street_selection = address_index.rows(key, identifier)
+    if len(street_selection) > 0:
+        result["LOG_LGRD"] = [street_found_logs[search_mode]]
     if len(street_selection) == 0:
-        return {key: str(value[0]) for key, value in result.items()}
+        return {col: str(value[0]) for col, value in result.items()}
 
     address_number = clean_number(address_number)
-    located_address = street_selection[street_selection["NUM_IMOV"] == address_number]
-    if len(located_address) > 0:
-        for key, value in located_address.to_dict(orient="list").items():
-            result[key] = value
+    # Rows of a street are sorted by NUM_IMOV, so the first match is the leftmost one
+    street_numbers = address_columns["NUM_IMOV"][street_selection]
+    position = np.searchsorted(street_numbers, address_number)
+    if position < len(street_numbers) and street_numbers[position] == address_number:
+        located_address = street_selection[position]
+        for col, value in address_columns.items():
+            result[col] = [value[located_address]]
         result["LOG_NUMR"] = ["End. oficial"]
     else:
         result = interpolate_position()
-    return {key: str(value[0]) for key, value in result.items()}
+    return {col: str(value[0]) for col, value in result.items()}
+
+
+def get_closest_neighbours_batch(
+    address_index: AddressIndex, key: str, groups: np.ndarray, numbers: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized form of get_closest_neighbours() for many (street, number) pairs,
+    with -1 in place of missing neighbours
+    """
+    side_rows, sorted_keys = address_index.sides(key)
+    address_numbers = address_index.columns["NUM_IMOV"]
+    query_keys = side_keys(groups, numbers)
+    side_start = query_keys - query_keys % SIDE_SCALE
+    side_start, side_stop = (
+        np.searchsorted(sorted_keys, side_start),
+        np.searchsorted(sorted_keys, side_start + SIDE_SCALE),
+    )
+    position = np.searchsorted(sorted_keys, query_keys)
+
+    # Numbers are sorted within each side of the street, so the two closest
+    # addresses are among the ones right before and after the searched number
+    candidates = position[:, None] + np.arange(-3, 3)
+    valid = (candidates >= side_start[:, None]) & (candidates < side_stop[:, None])
+    candidates = side_rows[np.where(valid, candidates, 0)]
+    candidate_numbers = address_numbers[candidates]
+    distances = np.where(
+        valid, np.abs(candidate_numbers - numbers[:, None]), np.iinfo(np.int64).max
+    )
+    closest = np.lexsort((candidates, distances))[:, :2]
+    neighbours = np.take_along_axis(candidates, closest, axis=1)
+    neighbours[~np.take_along_axis(valid, closest, axis=1)] = -1
+
+    # A number shared by several streets (CEP or name searches) may have more
+    # occurrences than fit in the window, so those are searched one by one
+    repeated = (
+        (candidate_numbers[:, 1:] == candidate_numbers[:, :-1])
+        & valid[:, 1:]
+        & valid[:, :-1]
+    ).any(axis=1)
+    for i in np.flatnonzero(repeated):
+        closest_rows = get_closest_neighbours(
+            address_index,
+            numbers[i],
+            address_index.group_rows(key, groups[i]),
+        )
+        neighbours[i] = -1
+        neighbours[i, : len(closest_rows)] = closest_rows
+    return neighbours
+
+
+def get_interpolation_neighbours(
+    address_index: AddressIndex, key: str, groups: np.ndarray, numbers: np.ndarray
+) -> np.ndarray:
+    """
+    Rows of the two addresses each (street, number) pair is interpolated from, with
+    -1 in place of missing neighbours. When the number lies between two addresses
+    on the same side of the street that are both within MAX_ADDRESS_DELTA, those
+    are its neighbours (the first row of each number). Otherwise the position is
+    extrapolated from the two closest addresses, as get_closest_neighbours() finds
+    """
+    if key == "CEP":
+        return get_cep_neighbours(address_index, groups, numbers)
+    neighbours = get_closest_neighbours_batch(address_index, key, groups, numbers)
+
+    # Numbers are sorted within each side of the street, so the addresses right
+    # before and after the searched number are found by two binary searches
+    side_rows, sorted_keys = address_index.sides(key)
+    query_keys = side_keys(groups, numbers)
+    side_start = query_keys - query_keys % SIDE_SCALE
+    side_start, side_stop = (
+        np.searchsorted(sorted_keys, side_start),
+        np.searchsorted(sorted_keys, side_start + SIDE_SCALE),
+    )
+    lower = np.searchsorted(sorted_keys, query_keys) - 1
+    upper = np.searchsorted(sorted_keys, query_keys, side="right")
+    bracketed = (lower >= side_start) & (upper < side_stop)
+    lower_keys = sorted_keys[np.maximum(lower, 0)]
+    upper_keys = sorted_keys[np.minimum(upper, len(sorted_keys) - 1)]
+    bracketed &= (query_keys - lower_keys <= MAX_ADDRESS_DELTA) & (
+        upper_keys - query_keys <= MAX_ADDRESS_DELTA
+    )
+    lower = np.searchsorted(sorted_keys, lower_keys[bracketed])
+    neighbours[bracketed, 0] = side_rows[lower]
+    neighbours[bracketed, 1] = side_rows[upper[bracketed]]
+    return neighbours
+
+
+def get_cep_neighbours(
+    address_index: AddressIndex, groups: np.ndarray, numbers: np.ndarray
+) -> np.ndarray:
+    """
+    get_interpolation_neighbours() for CEP groups. A CEP may span several streets,
+    so the neighbours are searched in each of them and taken from a single one:
+    preferably a street whose numbers bracket the searched number, then the one
+    whose neighbours are closest to it, then the first one by COD_LOGR
+    """
+    starts, stops = address_index.cep_streets(groups)
+    counts = stops - starts
+    queries = np.repeat(np.arange(len(groups)), counts)
+    streets = np.arange(counts.sum()) + np.repeat(
+        starts - np.cumsum(counts) + counts, counts
+    )
+    street_numbers = numbers[queries]
+    candidates = get_interpolation_neighbours(
+        address_index, CEP_STREETS, streets, street_numbers
+    )
+    found = (candidates >= 0).all(axis=1)
+    candidate_numbers = address_index.columns["NUM_IMOV"][candidates]
+    distance = np.abs(candidate_numbers - street_numbers[:, None]).max(axis=1)
+    found &= distance <= MAX_ADDRESS_DELTA
+    bracketed = (candidate_numbers[:, 0] < street_numbers) & (
+        candidate_numbers[:, 1] > street_numbers
+    )
+    best = np.lexsort((streets, distance, ~bracketed, ~found, queries))
+    chosen = np.flatnonzero(counts > 0)
+    first = best[np.searchsorted(queries[best], chosen)]
+
+    neighbours = np.full((len(groups), 2), -1, dtype=np.int64)
+    neighbours[chosen] = np.where(found[first, None], candidates[first], -1)
+    return neighbours
+
+
+def geocode_columns(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    streets: list[str],
+    address_numbers: list[str],
+    search_mode: SearchMode,
+) -> dict[str, np.ndarray]:
+    """
+    Vectorized form of geocode() for many addresses, grouped by street: each
+    distinct street is looked up once, then all the numbers are found by a single
+    binary search over the addresses sorted by street, side of the street and
+    number. Returns the result columns (the keys of geocode() results) as text
+    """
+    key = street_keys[search_mode]
+    address_columns = address_index.columns
+
+    # Street identifiers and address numbers are cleaned once per distinct value,
+    # missing values included, which are then blank as in geocode()
+    street_codes, street_values = pd.factorize(
+        np.asarray(streets, dtype=object), use_na_sentinel=False
+    )
+    street_values = [text_value(s) for s in street_values]
+    if search_mode == SearchMode.BY_NAME:
+        match_street_names(street_matcher, street_values)
+        identifiers = [match_street_name(street_matcher, s) for s in street_values]
+    else:
+        identifiers = [clean_number(s) for s in street_values]
+    groups = address_index.groups(key, identifiers)[street_codes]
+    number_codes, number_values = pd.factorize(
+        np.asarray(address_numbers, dtype=object), use_na_sentinel=False
+    )
+    number_values = [clean_number(text_value(n)) for n in number_values]
+    numbers = np.array([min(n, SIDE_SCALE - 1) for n in number_values], dtype=np.int64)[
+        number_codes
+    ]
+    number_texts = np.array([str(n) for n in number_values], dtype=object)
+
+    result = {col: np.full(len(groups), "", dtype=object) for col in result_columns}
+    street_found = groups >= 0
+    result["LOG_LGRD"] = np.where(
+        street_found, street_found_logs[search_mode], "Não localizado"
+    ).astype(object)
+    result["LOG_NUMR"][:] = "Não localizado"
+
+    # Official addresses: the first row of the street with the same number
+    side_rows, sorted_keys = address_index.sides(key)
+    query_keys = side_keys(groups, numbers)
+    position = np.minimum(np.searchsorted(sorted_keys, query_keys), len(side_rows) - 1)
+    exact = street_found & (sorted_keys[position] == query_keys)
+    exact_rows = side_rows[position[exact]]
+    for col, values in address_columns.items():
+        result[col][exact] = values[exact_rows].astype(str)
+    result["LOG_NUMR"][exact] = "End. oficial"
+
+    # Remaining addresses are interpolated from their neighbours
+    approximate = np.flatnonzero(street_found & ~exact)
+    neighbours = get_interpolation_neighbours(
+        address_index, key, groups[approximate], numbers[approximate]
+    )
+    neighbour_numbers = address_columns["NUM_IMOV"][neighbours]
+    interpolated = (neighbours >= 0).all(axis=1) & (
+        np.abs(neighbour_numbers - numbers[approximate, None]) <= MAX_ADDRESS_DELTA
+    ).all(axis=1)
+    approximate = approximate[interpolated]
+    smaller, bigger = neighbours[interpolated, 0], neighbours[interpolated, 1]
+    for col in [
+        "REGIONAL",
+        "AA",
+        "QT",
+        "CEP",
+        "COD_LOGR",
+        "TIPOLOGR",
+        "NOMELOGR",
+        "BAIRRO",
+    ]:
+        values = address_columns[col]
+        result[col][approximate] = np.where(
+            values[smaller] == values[bigger],
+            values[smaller].astype(str),
+            "Indeterminado",
+        )
+    result["NUM_IMOV"][approximate] = number_texts[number_codes[approximate]]
+    delta_neighbours = (
+        address_columns["NUM_IMOV"][bigger] - address_columns["NUM_IMOV"][smaller]
+    ).astype(float)
+    delta_address = (
+        numbers[approximate] - address_columns["NUM_IMOV"][smaller]
+    ).astype(float)
+    same_number = delta_neighbours == 0.0
+    delta_neighbours[same_number] = 1.0
+    coordinates = {}
+    for col in ["X", "Y"]:
+        values = address_columns[col]
+        slope = (values[bigger] - values[smaller]).astype(float) / delta_neighbours
+        coordinate = values[smaller].astype(float) + (delta_address * slope)
+        coordinates[col] = np.round(coordinate, 0).astype(np.int64)
+        result[col][approximate] = np.where(
+            same_number, "", coordinates[col].astype(str)
+        )
+    result["LOG_NUMR"][approximate] = "End. aproximado"
+
+    # Interpolated points take the areas of the polygons that contain them, if any,
+    # instead of being indeterminate when their neighbours are in different ones
+    if address_index.areas is not None:
+        placed = ~same_number
+        areas = address_index.areas.lookup(
+            coordinates["X"][placed], coordinates["Y"][placed]
+        )
+        for col, values in areas.items():
+            found = pd.notna(values)
+            result[col][approximate[placed][found]] = values[found]
+    return result
+
+
+def geocode_batch(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    streets: list[str],
+    address_numbers: list[str],
+    search_mode: SearchMode,
+) -> list[dict[str, str]]:
+    """
+    Same results as calling geocode() on each address, computed by geocode_columns()
+    """
+    result = geocode_columns(
+        address_index, street_matcher, streets, address_numbers, search_mode
+    )
+    values = [result[col].astype(str).tolist() for col in result_columns]
+    return [dict(zip(result_columns, row)) for row in zip(*values)]
+
+
+def geocode_dataframe(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    df: pd.DataFrame,
+    street_col: str,
+    number_col: str,
+    search_mode: SearchMode,
+) -> pd.DataFrame:
+    """
+    Geocodes all the rows of a DataFrame at once, with the same results as calling
+    geocode() on each of them, and returns them joined to the input columns.
+    Missing values are blank, and integers read as floats lose their ".0"
+    """
+    result = geocode_columns(
+        address_index,
+        street_matcher,
+        [text_value(value) for value in df[street_col].tolist()],
+        [text_value(value) for value in df[number_col].tolist()],
+        search_mode,
+    )
+    geocoded = df.loc[
+        :, [col for col in df.columns if col not in output_columns]
+    ].copy()
+    for col in output_columns:
+        geocoded[col] = result[col]
+    return geocoded
+
+
+def geocode_rows(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    rows: list[dict[str, str]],
+    search_order: list[tuple[SearchMode, str]],
+    col_address_number: str,
+    result_cache: Optional[ResultCache] = None,
+    lookups: Optional[Counter] = None,
+) -> list[dict[str, str]]:
+    """
+    Search cascade over a batch of rows: each (mode, column) step of search_order
+    is only tried on the rows whose street was not found by the previous steps.
+
+    Rows with the same lookup_key() at a step share a single result, which is only
+    computed if it is not in result_cache (new ones are added to it). The number
+    of lookups and of distinct ones are added up in *lookups*, if given
+    """
+    results = [result_not_found] * len(rows)
+    pending = range(len(rows))
+    for step_mode, step_column in search_order:
+        if len(pending) == 0:
+            break
+        keys = {
+            i: lookup_key(step_mode, rows[i][step_column], rows[i][col_address_number])
+            for i in pending
+        }
+        first_rows = {}
+        for i, key in keys.items():
+            first_rows.setdefault(key, i)
+        if lookups is not None:
+            lookups["total"] += len(keys)
+            lookups["distinct"] += len(first_rows)
+
+        step_results = {}
+        if result_cache is not None:
+            step_results = result_cache.get_many(first_rows)
+        missing_rows = [i for key, i in first_rows.items() if key not in step_results]
+        new_results = dict(
+            zip(
+                [keys[i] for i in missing_rows],
+                geocode_batch(
+                    address_index,
+                    street_matcher,
+                    [rows[i][step_column] for i in missing_rows],
+                    [rows[i][col_address_number] for i in missing_rows],
+                    step_mode,
+                ),
+            )
+        )
+        if result_cache is not None and new_results:
+            result_cache.put_many(new_results)
+        step_results.update(new_results)
+
+        still_pending = []
+        for i in pending:
+            result = step_results[keys[i]]
+            if result["LOG_LGRD"] != "Não localizado":
+                results[i] = result
+            else:
+                still_pending.append(i)
+        pending = still_pending
+    return results
+
+
+def start_worker(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    result_cache: Optional[ResultCache] = None,
+) -> None:
+    """
+    Initializer of the processes in worker_pool(): the address data reaches each
+    worker once (inherited, where processes are forked), not with every task
+    """
+    street_matcher.cache.added = {}
+    worker_context.update(
+        address_index=address_index,
+        street_matcher=street_matcher,
+        result_cache=result_cache,
+    )
+
+
+def worker_pool(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    workers: int,
+    result_cache: Optional[ResultCache] = None,
+) -> ProcessPoolExecutor:
+    """
+    Processes that geocode chunks of rows for geocode_file(), which may be shared
+    by the calls for several files
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=start_worker,
+        initargs=(address_index, street_matcher, result_cache),
+    )
+
+
+def geocode_chunk(
+    rows: list[dict[str, str]],
+    search_order: list[tuple[SearchMode, str]],
+    col_address_number: str,
+    input_columns: list[str],
+) -> tuple[list[list[str]], dict, Counter]:
+    """
+    Task run by the worker processes: output lines for a chunk of rows, the fuzzy
+    matches found meanwhile, to be merged into the main process cache, and the
+    lookup counts of geocode_rows()
+    """
+    street_matcher = worker_context["street_matcher"]
+    lookups = Counter()
+    results = geocode_rows(
+        worker_context["address_index"],
+        street_matcher,
+        rows,
+        search_order,
+        col_address_number,
+        worker_context["result_cache"],
+        lookups,
+    )
+    new_matches, street_matcher.cache.added = street_matcher.cache.added, {}
+    return join_results(rows, results, input_columns), new_matches, lookups
 
 
 def geocode_file(
-    address_data: pd.DataFrame,
-    street_list: list[str],
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
     file: Union[str, os.PathLike] = None,
     col_street_code: str = None,
     col_street_cep: str = None,
     col_street_name: str = None,
     col_address_number: str = None,
+    workers: int = 1,
+    executor: ProcessPoolExecutor = None,
+    result_cache: Optional[ResultCache] = None,
 ) -> dict[str, int]:
+    """
+    Geocodes a CSV or DBF file to OUTPUT_FOLDER and returns the statistics saved
+    to its log. With more than one worker, chunks are geocoded by *executor*, a
+    worker_pool() with that many processes, or by a pool started for this file.
+    Results are reused across runs through result_cache, if given
+    """
     start_time = time.perf_counter()
-    not_found_pool = []
 
     # Determine geocoding order
     street_identifiers = {
@@ -217,79 +809,95 @@ def geocode_file(
         SearchMode.BY_NAME: (col_street_name, "nome de logradouro"),
     }
     search_order = [
-        (mode, col)
+        (mode, col[0])
         for mode, col in street_identifiers.items()
         if col[0] != "--- AUSENTE NESTE ARQUIVO ---"
     ]
+    search_labels = [
+        col[1]
+        for col in street_identifiers.values()
+        if col[0] != "--- AUSENTE NESTE ARQUIVO ---"
+    ]
 
     # Set output filename
     basename, _ = os.path.splitext(os.path.basename(file))
     output_file = os.path.join(OUTPUT_FOLDER, basename + ".csv")
 
     # Initiate csv output
-    with open(output_file, "w", newline="", encoding=OUTPUT_ENCODING) as csvfile:
-        stream = csv.writer(csvfile, delimiter=";")
-        column_names = [
+    with open(
+        output_file,
+        "w",
+        newline="",
+        encoding=OUTPUT_ENCODING,
+        buffering=OUTPUT_BUFFER_SIZE,
+    ) as csvfile:
+        input_columns = [
             name for name in fp.get_columns(file) if name not in output_columns
         ]
-        column_names.extend(output_columns)
-        stream.writerow(column_names)
-
-        # Call geocoding steps
-        first_round = True
-        for step in search_order:
-            step_mode, step_column = step
-            if first_round:
-                first_round = False
-                file_streamer = fp.file_streamer(file)
-                sp = cli.spinner(f"Pesquisando endereços por {step_column[1]}")
-                sp.start()
-                for row in file_streamer:
-                    result = geocode(
-                        address_data,
-                        street_list,
-                        row[step_column[0]],
-                        row[col_address_number],
-                        step_mode,
-                    )
-                    if result["LOG_LGRD"] != "Não localizado":
-                        stream.writerow(join_result(row, result))
-                    else:
-                        not_found_pool.append(row)
-                sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
-            elif len(not_found_pool) > 0:
-                sp = cli.spinner(
-                    f"Pesquisando endereços remanescentes por {step_column[1]}"
-                )
-                sp.start()
-                for row in not_found_pool:
-                    result = geocode(
-                        address_data,
-                        street_list,
-                        row[step_column[0]],
-                        row[col_address_number],
-                        step_mode,
+        csv.writer(csvfile, delimiter=";").writerow(input_columns + output_columns)
+        stream = fp.OrderedCsvWriter(
+            csvfile, delimiter=";", max_pending=CHUNKS_PER_WORKER * workers
+        )
+
+        # Call geocoding steps, one chunk of rows at a time
+        sp = cli.spinner(f"Pesquisando endereços por {', '.join(search_labels)}")
+        sp.start()
+        try:
+            chunks = fp.chunk_streamer(fp.file_streamer(file), CHUNK_SIZE)
+            lookups = Counter()
+            if workers <= 1:
+                for sequence, rows in enumerate(chunks):
+                    results = geocode_rows(
+                        address_index,
+                        street_matcher,
+                        rows,
+                        search_order,
+                        col_address_number,
+                        result_cache,
+                        lookups,
                     )
-                    if result["LOG_LGRD"] != "Não localizado":
-                        stream.writerow(join_result(row, result))
-                        not_found_pool.remove(row)
-                sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+                    stream.write(sequence, join_results(rows, results, input_columns))
             else:
-                break
-
-        # Put the rows in "not_found_pool" back to the output
-        result_not_found = {
-            "REGIONAL": "",
-            "AA": "",
-            "QT": "",
-            "BAIRRO": "",
-            "X": "",
-            "Y": "",
-            "LOG_LGRD": "Não localizado",
-            "LOG_NUMR": "Não localizado",
-        }
-        for row in not_found_pool:
-            stream.writerow(join_result(row, result_not_found))
+                own_executor = executor is None
+                if own_executor:
+                    executor = worker_pool(
+                        address_index, street_matcher, workers, result_cache
+                    )
+                running = {}
+
+                def write_finished_chunks(return_when: str) -> None:
+                    finished, _ = wait(running, return_when=return_when)
+                    for future in finished:
+                        lines, new_matches, chunk_lookups = future.result()
+                        lookups.update(chunk_lookups)
+                        for street_name, street_match in new_matches.items():
+                            street_matcher.cache.put(street_name, street_match)
+                        stream.write(running.pop(future), lines)
+
+                try:
+                    for sequence, rows in enumerate(chunks):
+                        # Chunks running or waiting for their turn are kept in check
+                        while stream.full(len(running)):
+                            write_finished_chunks(FIRST_COMPLETED)
+                        running[
+                            executor.submit(
+                                geocode_chunk,
+                                rows,
+                                search_order,
+                                col_address_number,
+                                input_columns,
+                            )
+                        ] = sequence
+                    write_finished_chunks(ALL_COMPLETED)
+                finally:
+                    if own_executor:
+                        executor.shutdown()
+        except Exception:
+            sp.fail()
+            raise
+        sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+
+    street_matcher.save_cache()
     end_time = time.perf_counter()
     elapsed_time = round(end_time - start_time, ndigits=1)
 
@@ -313,6 +921,10 @@ def geocode_file(
         "ENDEREÇOS GEOCODIFICADOS": total_found,
         "TOTAL DE ENDEREÇOS": total_addresses,
         "TAXA DE SUCESSO": round(100 * total_found / total_addresses, ndigits=1),
+        # Share of the lookups answered by an identical one in the same chunk
+        "TAXA DE DEDUPLICAÇÃO": round(
+            100 * (1 - lookups["distinct"] / max(lookups["total"], 1)), ndigits=1
+        ),
         "TEMPO DE PROCESSAMENTO (segundos)": elapsed_time,
     }
 
@@ -331,3 +943,144 @@ def geocode_file(
         f.write(stats_text)
 
     return stats
+
+
+def reverse_geocode_columns(
+    address_index: AddressIndex,
+    coordinate_index: CoordinateIndex,
+    x: np.ndarray,
+    y: np.ndarray,
+    max_distance: Optional[float] = None,
+) -> dict[str, np.ndarray]:
+    """
+    Nearest address to each point (in EPSG:31983) as text columns, in the order of
+    reverse_output_columns, left blank for the points without an address
+    """
+    rows, distances = coordinate_index.nearest(x, y, max_distance)
+    found = np.flatnonzero(rows >= 0)
+    columns = {}
+    for col in reverse_output_columns[:-1]:
+        columns[col] = np.full(len(rows), "", dtype=object)
+        columns[col][found] = address_index.columns[col][rows[found]].astype(str)
+    columns["DISTANCIA"] = np.full(len(rows), "", dtype=object)
+    columns["DISTANCIA"][found] = (
+        np.round(distances[found]).astype(np.int64).astype(str)
+    )
+    return columns
+
+
+def reverse_geocode(
+    address_index: AddressIndex,
+    coordinate_index: CoordinateIndex,
+    x: str,
+    y: str,
+    crs: Optional[str] = None,
+    max_distance: Optional[float] = None,
+) -> dict[str, str]:
+    """
+    Nearest address to a single point, given as text in the reference system crs
+    (EPSG:31983 by default)
+    """
+    x, y = project_coordinates(parse_coordinates([x]), parse_coordinates([y]), crs)
+    columns = reverse_geocode_columns(
+        address_index, coordinate_index, x, y, max_distance
+    )
+    return {col: values[0] for col, values in columns.items()}
+
+
+def reverse_geocode_rows(
+    address_index: AddressIndex,
+    coordinate_index: CoordinateIndex,
+    rows: list[dict[str, str]],
+    col_x: str,
+    col_y: str,
+    input_columns: list[str],
+    crs: Optional[str] = None,
+    max_distance: Optional[float] = None,
+) -> list[list[str]]:
+    """
+    Output lines of a chunk of rows: the input columns followed by
+    reverse_output_columns
+    """
+    x, y = project_coordinates(
+        parse_coordinates([row[col_x] for row in rows]),
+        parse_coordinates([row[col_y] for row in rows]),
+        crs,
+    )
+    columns = reverse_geocode_columns(
+        address_index, coordinate_index, x, y, max_distance
+    )
+    return [
+        [row[col] for col in input_columns] + list(values)
+        for row, values in zip(
+            rows, zip(*(columns[col] for col in reverse_output_columns))
+        )
+    ]
+
+
+def reverse_geocode_file(
+    address_index: AddressIndex,
+    coordinate_index: CoordinateIndex,
+    file: Union[str, os.PathLike] = None,
+    col_x: str = None,
+    col_y: str = None,
+    crs: Optional[str] = None,
+    max_distance: Optional[float] = None,
+) -> dict[str, int]:
+    """
+    Writes the nearest address to the coordinates of each row of a CSV or DBF file
+    to OUTPUT_FOLDER, as <file>_reverso.csv, and returns the statistics saved to
+    its log
+    """
+    start_time = time.perf_counter()
+    basename, _ = os.path.splitext(os.path.basename(file))
+    output_file = os.path.join(OUTPUT_FOLDER, basename + "_reverso.csv")
+    distances = []
+    total_points = 0
+    with open(
+        output_file,
+        "w",
+        newline="",
+        encoding=OUTPUT_ENCODING,
+        buffering=OUTPUT_BUFFER_SIZE,
+    ) as csvfile:
+        input_columns = [
+            name for name in fp.get_columns(file) if name not in reverse_output_columns
+        ]
+        writer = csv.writer(csvfile, delimiter=";")
+        writer.writerow(input_columns + reverse_output_columns)
+        sp = cli.spinner("Pesquisando os endereços mais próximos das coordenadas")
+        sp.start()
+        for rows in fp.chunk_streamer(fp.file_streamer(file), CHUNK_SIZE):
+            lines = reverse_geocode_rows(
+                address_index,
+                coordinate_index,
+                rows,
+                col_x,
+                col_y,
+                input_columns,
+                crs,
+                max_distance,
+            )
+            writer.writerows(lines)
+            total_points += len(lines)
+            distances.extend(int(line[-1]) for line in lines if line[-1])
+        sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+    elapsed_time = round(time.perf_counter() - start_time, ndigits=1)
+
+    stats = {
+        "ENDEREÇOS LOCALIZADOS": len(distances),
+        "TOTAL DE PONTOS": total_points,
+        "TAXA DE SUCESSO": round(
+            100 * len(distances) / max(total_points, 1), ndigits=1
+        ),
+        "DISTÂNCIA MEDIANA (metros)": round(float(np.median(distances)), ndigits=1)
+        if distances
+        else "",
+        "TEMPO DE PROCESSAMENTO (segundos)": elapsed_time,
+    }
+    stats_file = os.path.join(OUTPUT_FOLDER, basename + "_reverso_log.txt")
+    with open(stats_file, "w") as f:
+        f.write("".join(f"{key}: {value}\n\n" for key, value in stats.items()))
+
+    return stats
@@ -1,12 +1,36 @@
+import argparse
+import glob
+import json
 import os
-import pandas as pd
+import sqlite3
+import sys
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
 import colorama as color
 
 import util.cli as cli
 import util.file_parsing as fp
-from util.config import datatypes_dict, default_input_cols_as_text, default_input_dict
+from server import DEFAULT_HOST, DEFAULT_PORT, serve
+from stream import STREAM_BATCH_SIZE, stream_csv, stream_json
+from util.address_index import AddressIndex, load_address_index
+from util.area_index import load_area_index
+from util.config import default_input_cols_as_text, default_input_dict
+from util.coordinate_index import CoordinateIndex
+from util.result_cache import ResultCache
+from util.street_matcher import StreetMatcher
 from util.update_geodata import update_all
-from geocode import geocode, geocode_file, SearchMode
+from geocode import (
+    FUZZ_CUTOFF,
+    geocode,
+    geocode_file,
+    result_version,
+    reverse_geocode,
+    reverse_geocode_file,
+    worker_pool,
+    SearchMode,
+)
 
 VERSION = "1.0"
 DISCLAIMER = (
@@ -68,16 +92,73 @@ LOGO = """
 """
 ABSOLUTE_PATH = os.path.dirname(__file__)
 DATA = os.path.join(ABSOLUTE_PATH, "geodata", "base_enderecos.csv")
+FUZZ_CACHE = os.path.join(ABSOLUTE_PATH, "geodata", "cache_logradouros.json")
+RESULT_CACHE = os.path.join(ABSOLUTE_PATH, "geodata", "cache_resultados.sqlite")
+AREAS = os.path.join(ABSOLUTE_PATH, "geodata", "base_areas")
+MISSING_DATA_TEXT = (
+    "A base de endereços não foi detectada neste computador. Execute a ação "
+    "*Atualizar dados geográficos* no menu interativo antes de prosseguir."
+)
+
+
+def load_address_data() -> tuple[AddressIndex, StreetMatcher, Optional[ResultCache]]:
+    address_index = load_address_index(DATA)
+    address_index.areas = load_area_index(AREAS)
+    street_matcher = StreetMatcher(
+        address_index.unique("NOMELOGR"), FUZZ_CUTOFF, FUZZ_CACHE
+    )
+    # Geocoding works the same without the result cache, only slower
+    try:
+        result_cache = ResultCache(
+            RESULT_CACHE, result_version(address_index, street_matcher)
+        )
+    except sqlite3.Error:
+        result_cache = None
+    return address_index, street_matcher, result_cache
+
 
-cli.clear_screen()
-print(color.Fore.GREEN + color.Style.BRIGHT + LOGO + color.Style.RESET_ALL)
+class AddressData:
+    """
+    Handle to the address index, street matcher and result cache, which are loaded
+    on a background thread while the menus are shown. get() only waits if loading
+    is not over yet, and starts it if reload() was never called
+    """
 
-if os.path.isfile(DATA):
-    sp = cli.spinner("Carregando base de endereços")
-    sp.start()
-    END = pd.read_csv(DATA, sep=";", dtype=datatypes_dict())
-    unique_streets = list(END["NOMELOGR"].sort_values().unique())
-    sp.stop()
+    def __init__(self):
+        self._loaded = threading.Event()
+        self._thread = None
+        self._data = None
+        self._error = None
+
+    def reload(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+        self._loaded.clear()
+        self._thread = threading.Thread(target=self._load, daemon=True)
+        self._thread.start()
+
+    def _load(self) -> None:
+        try:
+            self._data, self._error = load_address_data(), None
+        except Exception as error:
+            self._data, self._error = None, error
+        finally:
+            self._loaded.set()
+
+    def get(self) -> tuple[AddressIndex, StreetMatcher, Optional[ResultCache]]:
+        if self._thread is None:
+            self.reload()
+        if not self._loaded.is_set():
+            sp = cli.spinner("Carregando base de endereços")
+            sp.start()
+            self._loaded.wait()
+            sp.stop()
+        if self._error is not None:
+            raise self._error
+        return self._data
+
+
+ADDRESS_DATA = AddressData()
 
 
 def main_menu() -> str:
@@ -160,6 +241,7 @@ def search_single_address() -> None:
     """
     Interface to search individual addresses
     """
+    address_index, street_matcher, _ = ADDRESS_DATA.get()
     while True:
         cli.clear_screen()
         cli.print_title("PESQUISA INDIVIDUAL DE ENDEREÇOS")
@@ -167,7 +249,11 @@ def search_single_address() -> None:
         street_name = cli.text_question("Logradouro")
         address_number = cli.text_question("Número")
         result = geocode(
-            END, unique_streets, street_name, address_number, SearchMode.BY_NAME
+            address_index,
+            street_matcher,
+            street_name,
+            address_number,
+            SearchMode.BY_NAME,
         )
         if (
             result["LOG_LGRD"] == "Não localizado"
@@ -200,12 +286,14 @@ def search_single_address() -> None:
         address_number = ""
         repeat = cli.options("Pesquisar mais um endereço", "Retornar ao menu inicial")
         if repeat == "Retornar ao menu inicial":
+            street_matcher.save_cache()
             break
 
 
 def start_geocode_file(
     selected_file, col_street_code, col_street_cep, col_street_name, col_address_number
 ):
+    address_index, street_matcher, result_cache = ADDRESS_DATA.get()
     cli.clear_screen()
     cli.print_title("GEOCODIFICAR ARQUIVOS")
     print("                         Hora de tomar um cafezinho...")
@@ -226,13 +314,14 @@ def start_geocode_file(
     """
     )
     log = geocode_file(
-        END,
-        unique_streets,
+        address_index,
+        street_matcher,
         file=selected_file,
         col_street_code=col_street_code,
         col_street_cep=col_street_cep,
         col_street_name=col_street_name,
         col_address_number=col_address_number,
+        result_cache=result_cache,
     )
     cli.clear_screen()
     cli.print_title("GEOCODIFICAR ARQUIVOS")
@@ -411,6 +500,7 @@ def main() -> None:
     Main interface
     """
     cli.clear_screen()
+    print(color.Fore.GREEN + color.Style.BRIGHT + LOGO + color.Style.RESET_ALL)
     color.init(autoreset=True)
     DEFAULT_FOLDERS = [
         os.path.join(ABSOLUTE_PATH, "entrada"),
@@ -422,6 +512,9 @@ def main() -> None:
         if not os.path.exists(folder):
             os.makedirs(folder)
 
+    if os.path.isfile(DATA):
+        ADDRESS_DATA.reload()
+
     while True:
         action_choice = main_menu()
         if action_choice == "Geocodificar arquivo CSV ou DBF":
@@ -439,14 +532,7 @@ def main() -> None:
             if update_geodata == "SIM":
                 update_all()
                 if os.path.isfile(DATA):
-                    cli.clear_screen()
-                    sp = cli.spinner("Carregando a base de endereços atualizada")
-                    sp.start()
-                    global END
-                    global unique_streets
-                    END = pd.read_csv(DATA, sep=";", dtype=datatypes_dict())
-                    unique_streets = list(END["NOMELOGR"].sort_values().unique())
-                    sp.stop()
+                    ADDRESS_DATA.reload()
         if action_choice == "Exibir aviso legal":
             cli.clear_screen()
             cli.print_title("AVISO LEGAL", color_back=color.Back.YELLOW)
@@ -456,5 +542,332 @@ def main() -> None:
             quit()
 
 
+def expand_files(patterns: list[str]) -> list[str]:
+    """
+    Files matched by a list of names or glob patterns, without repetitions
+    """
+    files = []
+    for pattern in patterns:
+        files.extend(sorted(glob.glob(pattern)) or [pattern])
+    return list(dict.fromkeys(files))
+
+
+def geocode_files(args: argparse.Namespace) -> int:
+    """
+    Non-interactive geocoding of many files with a single load of the address data.
+    Returns the exit status: 1 if any of the files could not be geocoded
+    """
+    if not os.path.isfile(DATA):
+        print(MISSING_DATA_TEXT)
+        return 1
+    # Without any street column, the default columns present in each file are used
+    default_cols = default_input_dict()
+    street_cols = [args.code_col, args.cep_col, args.name_col]
+    use_default_cols = all(col is None for col in street_cols)
+    if use_default_cols:
+        street_cols = [
+            default_cols["codigo_logradouro"],
+            default_cols["cep"],
+            default_cols["nome_logradouro"],
+        ]
+    number_col = args.number_col or default_cols["numero_imovel"]
+
+    os.makedirs(os.path.join(ABSOLUTE_PATH, "resultado"), exist_ok=True)
+    address_index, street_matcher, result_cache = load_address_data()
+    executor = None
+    if args.workers > 1:
+        executor = worker_pool(
+            address_index, street_matcher, args.workers, result_cache
+        )
+    failures = 0
+    try:
+        for file in expand_files(args.files):
+            _, file_extension = os.path.splitext(file)
+            if not os.path.isfile(file) or file_extension.upper() not in [
+                ".CSV",
+                ".DBF",
+            ]:
+                print(f"{file}: arquivo CSV ou DBF não encontrado")
+                failures += 1
+                continue
+            try:
+                file_cols = fp.get_columns(file)
+            except Exception as error:
+                print(f"{file}: arquivo ilegível ({error})")
+                failures += 1
+                continue
+            missing_cols = [
+                col
+                for col in ([] if use_default_cols else street_cols) + [number_col]
+                if col is not None and col not in file_cols
+            ]
+            present_cols = [
+                col if col in file_cols else "--- AUSENTE NESTE ARQUIVO ---"
+                for col in street_cols
+            ]
+            if missing_cols or all(
+                col == "--- AUSENTE NESTE ARQUIVO ---" for col in present_cols
+            ):
+                print(
+                    f"{file}: colunas ausentes no arquivo ({', '.join(missing_cols)})"
+                )
+                failures += 1
+                continue
+            # A file that fails is reported, and the others are still geocoded
+            try:
+                stats = geocode_file(
+                    address_index,
+                    street_matcher,
+                    file=file,
+                    col_street_code=present_cols[0],
+                    col_street_cep=present_cols[1],
+                    col_street_name=present_cols[2],
+                    col_address_number=number_col,
+                    workers=args.workers,
+                    executor=executor,
+                    result_cache=result_cache,
+                )
+            except Exception as error:
+                print(f"{file}: falha ao geocodificar o arquivo ({error!r})")
+                failures += 1
+                # A worker that died leaves the pool unusable for the next files
+                if isinstance(error, BrokenProcessPool):
+                    executor.shutdown()
+                    executor = worker_pool(
+                        address_index, street_matcher, args.workers, result_cache
+                    )
+                continue
+            print(
+                f"{file}: {stats['ENDEREÇOS GEOCODIFICADOS']} de "
+                f"{stats['TOTAL DE ENDEREÇOS']} endereços geocodificados "
+                f"({stats['TAXA DE SUCESSO']}%)"
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return 1 if failures else 0
+
+
+def reverse_geocode_points(args: argparse.Namespace) -> int:
+    """
+    Nearest address to a single point (printed as JSON) or to the coordinates in
+    each row of many files, with the coordinate index built once for all of them.
+    Returns the exit status: 1 if any of the files could not be processed
+    """
+    if not os.path.isfile(DATA):
+        print(MISSING_DATA_TEXT)
+        return 1
+    if args.point is None and not args.files:
+        print("Informe as coordenadas de um ponto (--point) ou arquivos CSV ou DBF")
+        return 1
+    address_index = load_address_index(DATA)
+    coordinate_index = CoordinateIndex(address_index)
+    if args.point is not None:
+        try:
+            result = reverse_geocode(
+                address_index,
+                coordinate_index,
+                *args.point,
+                crs=args.crs,
+                max_distance=args.max_distance,
+            )
+        except ValueError as error:
+            print(error)
+            return 1
+        print(json.dumps(result, ensure_ascii=False))
+
+    os.makedirs(os.path.join(ABSOLUTE_PATH, "resultado"), exist_ok=True)
+    failures = 0
+    for file in expand_files(args.files):
+        _, file_extension = os.path.splitext(file)
+        if not os.path.isfile(file) or file_extension.upper() not in [".CSV", ".DBF"]:
+            print(f"{file}: arquivo CSV ou DBF não encontrado")
+            failures += 1
+            continue
+        file_cols = fp.get_columns(file)
+        missing_cols = [col for col in [args.x_col, args.y_col] if col not in file_cols]
+        if missing_cols:
+            print(f"{file}: colunas ausentes no arquivo ({', '.join(missing_cols)})")
+            failures += 1
+            continue
+        try:
+            stats = reverse_geocode_file(
+                address_index,
+                coordinate_index,
+                file=file,
+                col_x=args.x_col,
+                col_y=args.y_col,
+                crs=args.crs,
+                max_distance=args.max_distance,
+            )
+        except ValueError as error:
+            print(f"{file}: {error}")
+            failures += 1
+            continue
+        print(
+            f"{file}: {stats['ENDEREÇOS LOCALIZADOS']} de "
+            f"{stats['TOTAL DE PONTOS']} pontos com endereço próximo "
+            f"({stats['TAXA DE SUCESSO']}%)"
+        )
+    return 1 if failures else 0
+
+
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="onde.py",
+        description=f"Onde@BH v{VERSION} - Geocodificador de endereços em Belo "
+        "Horizonte. Sem argumentos, exibe o menu interativo.",
+    )
+    commands = parser.add_subparsers(dest="command")
+    geocode_parser = commands.add_parser(
+        "geocode",
+        help="geocodifica arquivos CSV ou DBF sem interação",
+        description="Geocodifica arquivos CSV ou DBF, salvando o resultado e o "
+        "relatório na pasta 'resultado'. Sem nenhuma coluna de logradouro, são "
+        "usadas as colunas padrão de util/config_entrada.yaml.",
+    )
+    geocode_parser.add_argument(
+        "files", nargs="+", help="arquivos ou padrões como entrada/*.csv"
+    )
+    geocode_parser.add_argument("--code-col", help="coluna com o código de logradouro")
+    geocode_parser.add_argument("--cep-col", help="coluna com o CEP")
+    geocode_parser.add_argument("--name-col", help="coluna com o nome do logradouro")
+    geocode_parser.add_argument("--number-col", help="coluna com o número do imóvel")
+    geocode_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processos que geocodificam os arquivos em paralelo (padrão: 1)",
+    )
+    serve_parser = commands.add_parser(
+        "serve",
+        help="inicia o servidor HTTP de geocodificação",
+        description="Mantém a base de endereços em memória e atende a pesquisas "
+        "individuais (GET /geocode) e em lote (POST /geocode, CSV ou JSON).",
+    )
+    serve_parser.add_argument("--host", default=DEFAULT_HOST)
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    stream_parser = commands.add_parser(
+        "stream",
+        help="geocodifica registros lidos da entrada padrão",
+        description="Lê um registro por linha da entrada padrão (JSON ou texto "
+        "delimitado com cabeçalho) e escreve na saída padrão o mesmo registro com "
+        "as colunas do resultado. Sem nenhuma coluna de logradouro, são usadas as "
+        "colunas padrão de util/config_entrada.yaml.",
+    )
+    stream_parser.add_argument("--format", choices=["json", "csv"], default="json")
+    stream_parser.add_argument("--delimiter", help="separador do texto delimitado")
+    stream_parser.add_argument("--code-col", help="coluna com o código de logradouro")
+    stream_parser.add_argument("--cep-col", help="coluna com o CEP")
+    stream_parser.add_argument("--name-col", help="coluna com o nome do logradouro")
+    stream_parser.add_argument("--number-col", help="coluna com o número do imóvel")
+    stream_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=STREAM_BATCH_SIZE,
+        help=f"máximo de registros por escrita na saída (padrão: {STREAM_BATCH_SIZE})",
+    )
+    reverse_parser = commands.add_parser(
+        "reverse",
+        help="encontra o endereço mais próximo de coordenadas",
+        description="Encontra o endereço da base mais próximo de um ponto, exibido "
+        "como JSON, ou das coordenadas de cada linha de arquivos CSV ou DBF, salvando "
+        "o resultado na pasta 'resultado' como <arquivo>_reverso.csv.",
+    )
+    reverse_parser.add_argument(
+        "files", nargs="*", help="arquivos ou padrões como entrada/*.csv"
+    )
+    reverse_parser.add_argument(
+        "--point", nargs=2, metavar=("X", "Y"), help="coordenadas de um único ponto"
+    )
+    reverse_parser.add_argument(
+        "--x-col", default="X", help="coluna com a coordenada X ou longitude"
+    )
+    reverse_parser.add_argument(
+        "--y-col", default="Y", help="coluna com a coordenada Y ou latitude"
+    )
+    reverse_parser.add_argument(
+        "--crs",
+        help="sistema de referência das coordenadas, como EPSG:4326 para GPS "
+        "(padrão: EPSG:31983)",
+    )
+    reverse_parser.add_argument(
+        "--max-distance",
+        type=float,
+        help="distância máxima em metros até o endereço (padrão: sem limite)",
+    )
+    return parser.parse_args(argv)
+
+
+def stream_records(args: argparse.Namespace) -> int:
+    """
+    Filter from stdin to stdout, for use in pipelines
+    """
+    if not os.path.isfile(DATA):
+        print(MISSING_DATA_TEXT, file=sys.stderr)
+        return 1
+    street_columns = {
+        mode: col
+        for mode, col in [
+            (SearchMode.BY_CODE, args.code_col),
+            (SearchMode.BY_CEP, args.cep_col),
+            (SearchMode.BY_NAME, args.name_col),
+        ]
+        if col is not None
+    }
+    sys.stdin.reconfigure(encoding="utf-8")
+    sys.stdout.reconfigure(encoding="utf-8")
+    address_index, street_matcher, result_cache = load_address_data()
+    try:
+        if args.format == "json":
+            stream_json(
+                address_index,
+                street_matcher,
+                sys.stdin,
+                sys.stdout,
+                street_columns,
+                args.number_col,
+                args.batch_size,
+                result_cache,
+            )
+        else:
+            stream_csv(
+                address_index,
+                street_matcher,
+                sys.stdin,
+                sys.stdout,
+                street_columns,
+                args.number_col,
+                args.batch_size,
+                args.delimiter,
+                result_cache,
+            )
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+    finally:
+        street_matcher.save_cache()
+    return 0
+
+
+def start_server(args: argparse.Namespace) -> int:
+    if not os.path.isfile(DATA):
+        print(MISSING_DATA_TEXT)
+        return 1
+    address_index, street_matcher, result_cache = load_address_data()
+    print(f"Servidor em http://{args.host}:{args.port}/geocode (<CTRL+C> encerra)")
+    serve(address_index, street_matcher, args.host, args.port, result_cache)
+    return 0
+
+
 if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    if args.command == "geocode":
+        sys.exit(geocode_files(args))
+    if args.command == "serve":
+        sys.exit(start_server(args))
+    if args.command == "stream":
+        sys.exit(stream_records(args))
+    if args.command == "reverse":
+        sys.exit(reverse_geocode_points(args))
     main()
@@ -0,0 +1,280 @@
+import csv
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from urllib.parse import parse_qs, urlparse
+
+import util.file_parsing as fp
+from geocode import (
+    SearchMode,
+    geocode_rows,
+    join_results,
+    output_columns,
+    reverse_geocode,
+    search_columns,
+    text_value,
+)
+from util.address_index import AddressIndex
+from util.coordinate_index import CoordinateIndex
+from util.result_cache import ResultCache
+from util.street_matcher import StreetMatcher
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+RESPONSE_CHUNK_SIZE = 1000  # Rows geocoded between writes of a batch response
+
+# Query parameters of GET /geocode, in the order of the search cascade
+search_parameters = {
+    SearchMode.BY_CODE: "code",
+    SearchMode.BY_CEP: "cep",
+    SearchMode.BY_NAME: "name",
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def read_csv_rows(body: str) -> tuple[list[str], Iterator[dict[str, str]]]:
+    """
+    Columns of the header line and every row, with missing fields blank
+    """
+    if not body.strip():
+        return [], iter([])
+    delimiter = csv.Sniffer().sniff(body.partition("\n")[0]).delimiter
+    reader = csv.DictReader(io.StringIO(body), delimiter=delimiter, restval="")
+    return list(reader.fieldnames or []), reader
+
+
+def read_json_rows(records: list) -> tuple[list[str], Iterator[dict[str, str]]]:
+    """
+    Columns of the first record and every record as text, with missing keys blank
+    """
+    if not all(isinstance(record, dict) for record in records):
+        raise BadRequest("O corpo da requisição deve conter objetos JSON")
+    columns = list(records[0].keys()) if records else []
+    rows = ({col: text_value(record.get(col)) for col in columns} for record in records)
+    return columns, rows
+
+
+def format_csv(lines: list[list[str]]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=";").writerows(lines)
+    return buffer.getvalue()
+
+
+class GeocodingHandler(BaseHTTPRequestHandler):
+    """
+    GET /geocode?code=...&cep=...&name=...&number=...
+        Geocodes one address with the identifiers given, in the same order as
+        geocode_file() tries them, and answers with a JSON object.
+
+    POST /geocode?code_col=...&cep_col=...&name_col=...&number_col=...
+        Geocodes a CSV, JSON (array of objects) or JSON lines body, according to its
+        Content-Type, and streams back the rows in the same format with the output
+        columns added. Columns not given default to the ones in config_entrada.yaml
+        that are present in the body. If geocoding fails midway, the connection is
+        closed and the body ends early (a JSON array is left unclosed).
+
+    GET /reverse?x=...&y=...&crs=...&max_distance=...
+        Nearest address to a point, in EPSG:31983 unless another crs is given
+        (such as EPSG:4326 for GPS longitude and latitude), as a JSON object.
+    """
+
+    server_version = "OndeBH"
+
+    def send_json(self, status: int, content) -> None:
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/reverse":
+            self.reverse_geocode(query)
+            return
+        if url.path != "/geocode":
+            self.send_json(404, {"erro": "Recurso não encontrado"})
+            return
+        search_order = [
+            (mode, parameter)
+            for mode, parameter in search_parameters.items()
+            if parameter in query
+        ]
+        if not search_order or "number" not in query:
+            self.send_json(
+                400, {"erro": "Informe o número e o código, CEP ou nome do logradouro"}
+            )
+            return
+        result = geocode_rows(
+            self.server.address_index,
+            self.server.street_matcher,
+            [query],
+            search_order,
+            "number",
+            self.server.result_cache,
+        )[0]
+        self.send_json(200, result)
+
+    def reverse_geocode(self, query: dict[str, str]) -> None:
+        if "x" not in query or "y" not in query:
+            self.send_json(400, {"erro": "Informe as coordenadas x e y"})
+            return
+        try:
+            max_distance = query.get("max_distance")
+            result = reverse_geocode(
+                self.server.address_index,
+                self.server.coordinate_index(),
+                query["x"],
+                query["y"],
+                query.get("crs"),
+                None if max_distance is None else float(max_distance),
+            )
+        except ValueError as error:
+            self.send_json(400, {"erro": str(error)})
+            return
+        self.send_json(200, result)
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path != "/geocode":
+            self.send_json(404, {"erro": "Recurso não encontrado"})
+            return
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        content_type = self.headers.get_content_type()
+        charset = self.headers.get_content_charset("utf-8")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            text = body.decode(charset)
+            if content_type == "text/csv":
+                input_columns, rows = read_csv_rows(text)
+            elif content_type == "application/json":
+                input_columns, rows = read_json_rows(json.loads(text))
+            elif content_type in ["application/x-ndjson", "application/jsonl"]:
+                input_columns, rows = read_json_rows(
+                    [json.loads(line) for line in text.splitlines() if line.strip()]
+                )
+            else:
+                raise BadRequest(f"Content-Type não suportado: {content_type}")
+            # The whole body is parsed before the response starts, so that it is
+            # rejected as a whole if it is malformed
+            rows = list(rows)
+            # An empty batch is answered with an empty one, whatever its columns
+            if rows:
+                search_order, col_address_number = search_columns(
+                    {
+                        mode: query[f"{parameter}_col"]
+                        for mode, parameter in search_parameters.items()
+                        if f"{parameter}_col" in query
+                    },
+                    query.get("number_col"),
+                    input_columns,
+                )
+        except (BadRequest, ValueError, csv.Error) as error:
+            self.send_json(400, {"erro": str(error)})
+            return
+
+        # The response is streamed without Content-Length, closing the connection
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.end_headers()
+        input_columns = [col for col in input_columns if col not in output_columns]
+        header = input_columns + output_columns
+        if content_type == "text/csv" and input_columns:
+            self.wfile.write(format_csv([header]).encode("utf-8"))
+        elif content_type == "application/json":
+            self.wfile.write(b"[")
+        separator = ""
+        try:
+            for chunk in fp.chunk_streamer(rows, RESPONSE_CHUNK_SIZE):
+                results = geocode_rows(
+                    self.server.address_index,
+                    self.server.street_matcher,
+                    chunk,
+                    search_order,
+                    col_address_number,
+                    self.server.result_cache,
+                )
+                lines = join_results(chunk, results, input_columns)
+                if content_type == "text/csv":
+                    text = format_csv(lines)
+                else:
+                    records = [
+                        json.dumps(dict(zip(header, line)), ensure_ascii=False)
+                        for line in lines
+                    ]
+                    if content_type == "application/json":
+                        text = separator + ",".join(records)
+                        separator = ","
+                    else:
+                        text = "".join(record + "\n" for record in records)
+                self.wfile.write(text.encode("utf-8"))
+                self.wfile.flush()
+        except Exception as error:
+            # The status is already sent: the connection is closed before the end
+            # of the body, so the client sees it truncated rather than complete
+            self.log_error("Falha ao geocodificar o lote: %r", error)
+            self.close_connection = True
+            return
+        if content_type == "application/json":
+            self.wfile.write(b"]")
+
+
+class GeocodingServer(ThreadingHTTPServer):
+    """
+    HTTP server that keeps the address data in memory, shared by the threads that
+    handle the requests
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address_index: AddressIndex,
+        street_matcher: StreetMatcher,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        result_cache: Optional[ResultCache] = None,
+    ):
+        super().__init__((host, port), GeocodingHandler)
+        self.address_index = address_index
+        self.street_matcher = street_matcher
+        self.result_cache = result_cache
+        self._coordinate_index = None
+        self._coordinate_lock = threading.Lock()
+
+    def coordinate_index(self) -> CoordinateIndex:
+        """
+        Index of the address coordinates, built by the first reverse lookup
+        """
+        with self._coordinate_lock:
+            if self._coordinate_index is None:
+                self._coordinate_index = CoordinateIndex(self.address_index)
+        return self._coordinate_index
+
+
+def serve(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    result_cache: Optional[ResultCache] = None,
+) -> None:
+    """
+    Runs the geocoding server until it is interrupted, then saves the match cache
+    """
+    with GeocodingServer(
+        address_index, street_matcher, host, port, result_cache
+    ) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            street_matcher.save_cache()
@@ -0,0 +1,145 @@
+import csv
+import json
+import queue
+import sys
+import threading
+from typing import Iterator, Optional, TextIO
+
+from geocode import (
+    SearchMode,
+    geocode_rows,
+    join_results,
+    output_columns,
+    search_columns,
+    text_value,
+)
+from util.address_index import AddressIndex
+from util.result_cache import ResultCache
+from util.street_matcher import StreetMatcher
+
+STREAM_BATCH_SIZE = 100  # Most records geocoded between writes to the output
+
+
+def read_lines(stream: TextIO, lines: queue.Queue) -> None:
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def line_batches(stream: TextIO, batch_size: int) -> Iterator[list[str]]:
+    """
+    Lines read on a background thread, grouped in batches of the lines that have
+    already arrived (up to batch_size), so no line waits for the following ones
+    """
+    lines = queue.Queue(maxsize=4 * batch_size)
+    threading.Thread(target=read_lines, args=(stream, lines), daemon=True).start()
+    while True:
+        line = lines.get()
+        if line is None:
+            return
+        batch = [line]
+        while len(batch) < batch_size:
+            try:
+                line = lines.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                yield batch
+                return
+            batch.append(line)
+        yield batch
+
+
+def stream_json(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    input_stream: TextIO,
+    output_stream: TextIO,
+    street_columns: dict[SearchMode, str],
+    col_address_number: Optional[str] = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+    result_cache: Optional[ResultCache] = None,
+) -> None:
+    """
+    Geocodes JSON lines: each object is written back with the output columns added.
+    Lines that are not JSON objects are reported to stderr and skipped
+    """
+    search_order, col_address_number = search_columns(
+        street_columns, col_address_number
+    )
+    search_cols = [col for _, col in search_order] + [col_address_number]
+    for batch in line_batches(input_stream, batch_size):
+        records = []
+        for line in batch:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict):
+                print(f"Registro ignorado: {line.strip()}", file=sys.stderr)
+                continue
+            records.append(record)
+        rows = [
+            {col: text_value(record.get(col)) for col in search_cols}
+            for record in records
+        ]
+        results = geocode_rows(
+            address_index,
+            street_matcher,
+            rows,
+            search_order,
+            col_address_number,
+            result_cache,
+        )
+        for record, result in zip(records, results):
+            record.update((col, result[col]) for col in output_columns)
+            output_stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output_stream.flush()
+
+
+def stream_csv(
+    address_index: AddressIndex,
+    street_matcher: StreetMatcher,
+    input_stream: TextIO,
+    output_stream: TextIO,
+    street_columns: dict[SearchMode, str],
+    col_address_number: Optional[str] = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+    delimiter: Optional[str] = None,
+    result_cache: Optional[ResultCache] = None,
+) -> None:
+    """
+    Geocodes delimited text with a header line and one record per line, written
+    back with the same delimiter and the output columns added
+    """
+    header = input_stream.readline()
+    if not header:
+        return
+    delimiter = delimiter or csv.Sniffer().sniff(header).delimiter
+    input_columns = next(csv.reader([header], delimiter=delimiter))
+    search_order, col_address_number = search_columns(
+        street_columns, col_address_number, input_columns
+    )
+    kept_columns = [col for col in input_columns if col not in output_columns]
+    writer = csv.writer(output_stream, delimiter=delimiter, lineterminator="\n")
+    writer.writerow(kept_columns + output_columns)
+    output_stream.flush()
+    blank_row = [""] * len(input_columns)
+    for batch in line_batches(input_stream, batch_size):
+        rows = [
+            dict(zip(input_columns, values + blank_row[len(values) :]))
+            for values in csv.reader(batch, delimiter=delimiter)
+            if values
+        ]
+        results = geocode_rows(
+            address_index,
+            street_matcher,
+            rows,
+            search_order,
+            col_address_number,
+            result_cache,
+        )
+        writer.writerows(join_results(rows, results, kept_columns))
+        output_stream.flush()
@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+
+from util.address_index import AddressIndex
+from util.street_matcher import StreetMatcher
+
+
+@pytest.fixture
+def address_data():
+    addresses = pd.DataFrame(
+        {
+            "REGIONAL": ["OESTE", "OESTE", "OESTE", "LESTE", "LESTE"],
+            "AA": ["AA1", "AA1", "AA2", "AA3", "AA3"],
+            "QT": [10, 10, 11, 20, 20],
+            "CEP": [30000100, 30000100, 30000100, 30000200, 30000200],
+            "COD_LOGR": [137, 137, 137, 250, 250],
+            "TIPOLOGR": ["RUA", "RUA", "RUA", "AVE", "AVE"],
+            "NOMELOGR": ["DAS FLORES", "DAS FLORES", "DAS FLORES", "BRASIL", "BRASIL"],
+            "NUM_IMOV": [10, 20, 30, 5, 15],
+            "BAIRRO": ["Centro", "Centro", "Centro", "Sion", "Sion"],
+            "X": [1000, 1010, 1020, 2000, 2010],
+            "Y": [5000, 5000, 5000, 6000, 6000],
+        }
+    )
+    address_index = AddressIndex(addresses)
+    return address_index, StreetMatcher(address_index.unique("NOMELOGR"), 90)
@@ -0,0 +1,19 @@
+import io
+
+import pytest
+
+from util.file_parsing import OrderedCsvWriter
+
+
+def test_ordered_writer_counts_chunks_in_flight():
+    output = io.StringIO()
+    stream = OrderedCsvWriter(output, delimiter=";", max_pending=2)
+    assert not stream.full(1)
+    stream.write(1, [["b"]])
+    assert stream.full(1)
+    assert not stream.full()
+    stream.write(2, [["c"]])
+    with pytest.raises(BufferError):
+        stream.write(3, [["d"]])
+    stream.write(0, [["a"]])
+    assert output.getvalue().split() == ["a", "b", "c"]
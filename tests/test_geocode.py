@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+import pytest
+from thefuzz import fuzz, process
+
+import geocode as geocode_module
+import util.street_matcher as street_matcher_module
+from geocode import (
+    SearchMode,
+    geocode,
+    geocode_batch,
+    geocode_dataframe,
+    geocode_file,
+    output_columns,
+)
+from util.address_index import AddressIndex
+from util.street_matcher import StreetMatcher
+
+
+@pytest.mark.parametrize(
+    "search_mode, streets",
+    [
+        (SearchMode.BY_CODE, ["137", None, np.nan, "137", "", "250"]),
+        (SearchMode.BY_CEP, ["30000100", None, np.nan, "30000100", "", "30000200"]),
+        (SearchMode.BY_NAME, ["RUA DAS FLORES", None, np.nan, "FLORES", "", None]),
+    ],
+)
+def test_batch_matches_geocode_with_missing_values(address_data, search_mode, streets):
+    address_index, street_matcher = address_data
+    numbers = ["20", "20", None, np.nan, "15", None]
+    batch = geocode_batch(address_index, street_matcher, streets, numbers, search_mode)
+    for street, number, result in zip(streets, numbers, batch):
+        assert result == geocode(
+            address_index, street_matcher, street, number, search_mode
+        )
+
+
+def test_missing_street_is_not_found(address_data):
+    address_index, street_matcher = address_data
+    batch = geocode_batch(
+        address_index, street_matcher, ["137", None], ["20", "20"], SearchMode.BY_CODE
+    )
+    assert batch[0]["LOG_NUMR"] == "End. oficial"
+    assert batch[1]["LOG_LGRD"] == "Não localizado"
+
+
+@pytest.mark.parametrize("number_dtype", ["Int64", "float64"])
+def test_dataframe_with_float_and_nullable_columns(address_data, number_dtype):
+    address_index, street_matcher = address_data
+    df = pd.DataFrame(
+        {
+            "COD": pd.Series([137, None, 250], dtype="float64"),
+            "NUM": pd.Series([20, 30, None], dtype=number_dtype),
+        }
+    )
+    geocoded = geocode_dataframe(
+        address_index, street_matcher, df, "COD", "NUM", SearchMode.BY_CODE
+    )
+    expected = [
+        geocode(address_index, street_matcher, street, number, SearchMode.BY_CODE)
+        for street, number in [("137", "20"), ("", "30"), ("250", "")]
+    ]
+    for col in output_columns:
+        assert geocoded[col].tolist() == [result[col] for result in expected]
+    assert geocoded["LOG_NUMR"].tolist()[0] == "End. oficial"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_geocode_file_with_short_rows(address_data, tmp_path, monkeypatch, workers):
+    address_index, street_matcher = address_data
+    (tmp_path / "resultado").mkdir()
+    monkeypatch.setattr(geocode_module, "OUTPUT_FOLDER", str(tmp_path / "resultado"))
+    file = tmp_path / "entrada.csv"
+    file.write_text("ID;COD;NUM\n1;137;20\n2;137\n3\n")
+    stats = geocode_file(
+        address_index,
+        street_matcher,
+        file,
+        "COD",
+        "--- AUSENTE NESTE ARQUIVO ---",
+        "--- AUSENTE NESTE ARQUIVO ---",
+        "NUM",
+        workers=workers,
+    )
+    lines = (tmp_path / "resultado" / "entrada.csv").read_text("cp1252").splitlines()
+    assert stats["TOTAL DE ENDEREÇOS"] == 3
+    assert lines[1].endswith(";End. oficial")
+    assert lines[2].startswith("2;137;;OESTE;")
+    assert lines[3].startswith("3;;;;")
+
+
+WORDS = ["SAO", "JOSE", "PADRE", "EUSTAQUIO", "DOUTOR", "ALVARO", "BRASIL", "FLORES"]
+
+
+@pytest.fixture
+def random_address_data():
+    """
+    Address base with several streets in each CEP and interleaved numbers
+    """
+    rng = np.random.default_rng(0)
+    names = list(
+        dict.fromkeys(
+            " ".join(rng.choice(WORDS, rng.integers(1, 4))) for _ in range(60)
+        )
+    )
+    rows = []
+    for street, name in enumerate(names):
+        cep = 30000000 + street // 3
+        numbers = np.unique(rng.integers(1, 400, rng.integers(2, 30)))
+        for number in numbers:
+            rows.append(
+                {
+                    "REGIONAL": f"R{street % 4}",
+                    "AA": f"AA{street % 7}",
+                    "QT": street % 11,
+                    "CEP": cep,
+                    "COD_LOGR": 100 + street,
+                    "TIPOLOGR": "RUA",
+                    "NOMELOGR": name,
+                    "NUM_IMOV": number,
+                    "BAIRRO": f"B{street % 5}",
+                    "X": 1000 * street + number,
+                    "Y": 2 * number,
+                }
+            )
+    address_index = AddressIndex(pd.DataFrame(rows))
+    return address_index, StreetMatcher(address_index.unique("NOMELOGR"), 90)
+
+
+def misspelled_streets(street_list: list[str], size: int) -> list[str]:
+    rng = np.random.default_rng(1)
+    letters = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ ")
+    queries = []
+    for _ in range(size):
+        query = list(rng.choice(street_list))
+        for _ in range(rng.integers(0, 4)):
+            position = rng.integers(0, len(query))
+            query[position : position + rng.integers(0, 2)] = rng.choice(
+                letters, rng.integers(0, 2)
+            )
+        queries.append("".join(query))
+    return queries
+
+
+def full_scan(street_matcher: StreetMatcher, queries: list[str]) -> list:
+    return [
+        process.extractOne(
+            query,
+            street_matcher.street_list,
+            scorer=fuzz.token_sort_ratio,
+            score_cutoff=street_matcher.score_cutoff,
+        )
+        for query in queries
+    ]
+
+
+def test_candidate_filter_equals_a_full_scan(random_address_data):
+    _, street_matcher = random_address_data
+    queries = misspelled_streets(street_matcher.street_list, 300)
+    assert [street_matcher.extract_one(query) for query in queries] == full_scan(
+        street_matcher, queries
+    )
+
+
+def test_batch_matching_equals_a_full_scan(random_address_data, monkeypatch):
+    _, street_matcher = random_address_data
+    # Several blocks of the score matrix
+    monkeypatch.setattr(street_matcher_module, "BATCH_CELLS", 500)
+    queries = misspelled_streets(street_matcher.street_list, 300)
+    assert street_matcher.extract_many(queries) == full_scan(street_matcher, queries)
+
+
+def test_parallel_output_equals_serial(random_address_data, tmp_path, monkeypatch):
+    address_index, street_matcher = random_address_data
+    monkeypatch.setattr(geocode_module, "CHUNK_SIZE", 7)
+    rng = np.random.default_rng(2)
+    lines = ["ID;COD;CEP;NOME;NUM"]
+    for i in range(200):
+        row = int(rng.integers(0, len(address_index)))
+        lines.append(
+            ";".join(
+                [
+                    str(i),
+                    str(address_index.columns["COD_LOGR"][row] * rng.integers(0, 2)),
+                    str(address_index.columns["CEP"][row]),
+                    address_index.columns["NOMELOGR"][row][: rng.integers(3, 30)],
+                    str(rng.integers(0, 420)),
+                ]
+            )
+        )
+    file = tmp_path / "entrada.csv"
+    file.write_text("\n".join(lines) + "\n")
+    outputs = []
+    for workers in [1, 3]:
+        folder = tmp_path / f"resultado{workers}"
+        folder.mkdir()
+        monkeypatch.setattr(geocode_module, "OUTPUT_FOLDER", str(folder))
+        geocode_file(
+            address_index,
+            street_matcher,
+            file,
+            "COD",
+            "CEP",
+            "NOME",
+            "NUM",
+            workers=workers,
+        )
+        outputs.append((folder / "entrada.csv").read_bytes())
+    assert outputs[0] == outputs[1]
+
+
+def test_cep_interpolation_stays_on_one_street(random_address_data):
+    address_index, street_matcher = random_address_data
+    ceps = address_index.unique("CEP")
+    streets = [str(cep) for cep in ceps for _ in range(1, 400)]
+    numbers = [str(number) for _ in ceps for number in range(1, 400)]
+    results = geocode_batch(
+        address_index, street_matcher, streets, numbers, SearchMode.BY_CEP
+    )
+    approximate = [r for r in results if r["LOG_NUMR"] == "End. aproximado"]
+    assert approximate
+    for result in approximate:
+        assert result["COD_LOGR"] != "Indeterminado"
+        rows = address_index.rows("COD_LOGR", int(result["COD_LOGR"]))
+        assert str(address_index.columns["CEP"][rows[0]]) == result["CEP"]
@@ -0,0 +1,39 @@
+import geocode
+import onde
+
+
+def test_failed_file_does_not_stop_the_batch(
+    address_data, tmp_path, monkeypatch, capsys
+):
+    address_index, street_matcher = address_data
+    (tmp_path / "resultado").mkdir()
+    monkeypatch.setattr(onde, "DATA", __file__)
+    monkeypatch.setattr(onde, "ABSOLUTE_PATH", str(tmp_path))
+    monkeypatch.setattr(geocode, "OUTPUT_FOLDER", str(tmp_path / "resultado"))
+    monkeypatch.setattr(
+        onde, "load_address_data", lambda: (address_index, street_matcher, None)
+    )
+
+    def geocode_file(*args, file, **kwargs):
+        if file.endswith("b.csv"):
+            raise RuntimeError("falha")
+        return geocode.geocode_file(*args, file=file, **kwargs)
+
+    monkeypatch.setattr(onde, "geocode_file", geocode_file)
+    files = []
+    for name in ["a.csv", "b.csv", "c.csv"]:
+        (tmp_path / name).write_text("COD;NUM\n137;20\n")
+        files.append(str(tmp_path / name))
+    args = onde.parse_arguments(
+        ["geocode", *files, "--code-col", "COD", "--number-col", "NUM"]
+    )
+    assert onde.geocode_files(args) == 1
+    output = capsys.readouterr().out
+    assert "b.csv: falha ao geocodificar o arquivo" in output
+    assert (tmp_path / "resultado" / "a.csv").exists()
+    assert (tmp_path / "resultado" / "c.csv").exists()
+
+
+def test_address_data_loads_on_first_get(monkeypatch):
+    monkeypatch.setattr(onde, "load_address_data", lambda: ("dados", None, None))
+    assert onde.AddressData().get() == ("dados", None, None)
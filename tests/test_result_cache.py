@@ -0,0 +1,66 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from util.result_cache import KEYS_PER_QUERY, STALE_VERSION_AGE, ResultCache
+
+real_time = time.time
+
+
+def test_get_many_in_chunks(tmp_path):
+    result_cache = ResultCache(tmp_path / "cache.sqlite", "1")
+    keys = [("BY_CODE", str(code), code) for code in range(2 * KEYS_PER_QUERY + 10)]
+    result_cache.put_many({key: {"NUMERO": str(key[2])} for key in keys[::2]})
+    missing = ("BY_NAME", "RUA DAS FLORES", 10**30)
+    results = result_cache.get_many(keys + keys[:5] + [missing])
+    assert results == {key: {"NUMERO": str(key[2])} for key in keys[::2]}
+
+
+def test_get_many_ignores_other_versions(tmp_path):
+    ResultCache(tmp_path / "cache.sqlite", "1").put_many({("BY_CODE", "1", 1): {}})
+    result_cache = ResultCache(tmp_path / "cache.sqlite", "2")
+    assert result_cache.get_many([("BY_CODE", "1", 1)]) == {}
+    assert result_cache.get_many([]) == {}
+
+
+def test_versions_share_the_file(tmp_path):
+    old = ResultCache(tmp_path / "cache.sqlite", "1")
+    old.put_many({("BY_CODE", "1", 1): {"NUMERO": "1"}})
+    new = ResultCache(tmp_path / "cache.sqlite", "2")
+    new.put_many({("BY_CODE", "1", 1): {"NUMERO": "2"}})
+    assert old.get_many([("BY_CODE", "1", 1)]) == {("BY_CODE", "1", 1): {"NUMERO": "1"}}
+    assert new.get_many([("BY_CODE", "1", 1)]) == {("BY_CODE", "1", 1): {"NUMERO": "2"}}
+
+
+def test_stale_versions_are_deleted(tmp_path, monkeypatch):
+    ResultCache(tmp_path / "cache.sqlite", "1").put_many({("BY_CODE", "1", 1): {}})
+    monkeypatch.setattr(time, "time", lambda: real_time() + STALE_VERSION_AGE + 1)
+    ResultCache(tmp_path / "cache.sqlite", "2")
+    monkeypatch.undo()
+    assert (
+        ResultCache(tmp_path / "cache.sqlite", "1").get_many([("BY_CODE", "1", 1)])
+        == {}
+    )
+
+
+worker_cache = {}
+
+
+def start_worker(result_cache: ResultCache) -> None:
+    worker_cache["result_cache"] = result_cache
+
+
+def worker_connection() -> int:
+    return id(worker_cache["result_cache"].connection())
+
+
+def test_forked_workers_open_their_own_connection(tmp_path):
+    result_cache = ResultCache(tmp_path / "cache.sqlite", "1")
+    with ProcessPoolExecutor(
+        1,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=start_worker,
+        initargs=(result_cache,),
+    ) as executor:
+        worker_id = executor.submit(worker_connection).result()
+    assert worker_id != id(result_cache.connection())
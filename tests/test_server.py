@@ -0,0 +1,107 @@
+import json
+import threading
+import urllib.request
+
+import pytest
+
+import server
+from server import GeocodingServer
+
+
+@pytest.fixture
+def server_url(address_data):
+    address_index, street_matcher = address_data
+    geocoding_server = GeocodingServer(address_index, street_matcher, port=0)
+    threading.Thread(target=geocoding_server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{geocoding_server.server_address[1]}"
+    geocoding_server.shutdown()
+    geocoding_server.server_close()
+
+
+def post(url: str, body: str, content_type: str) -> tuple[int, str]:
+    request = urllib.request.Request(
+        url, data=body.encode("utf-8"), headers={"Content-Type": content_type}
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as error:
+        return error.code, error.read().decode("utf-8")
+
+
+def test_csv_rows_with_missing_fields(server_url):
+    status, body = post(
+        f"{server_url}/geocode?code_col=COD&number_col=NUM",
+        "ID;COD;NUM\n1;137;20\n2;137\n",
+        "text/csv",
+    )
+    lines = body.splitlines()
+    assert status == 200
+    assert len(lines) == 3
+    assert (
+        lines[1]
+        == "1;137;20;OESTE;AA1;10;Centro;1010;5000;Loc. pelo código;End. oficial"
+    )
+    assert lines[2].startswith("2;137;;OESTE;")
+
+
+@pytest.mark.parametrize(
+    "body, content_type, expected",
+    [
+        ("[]", "application/json", []),
+        ("", "application/x-ndjson", ""),
+        ("", "text/csv", ""),
+    ],
+)
+def test_empty_batch(server_url, body, content_type, expected):
+    status, response = post(f"{server_url}/geocode", body, content_type)
+    assert status == 200
+    if content_type == "application/json":
+        assert json.loads(response) == expected
+    else:
+        assert response == expected
+
+
+def test_failed_chunk_truncates_the_body(server_url, monkeypatch):
+    geocode_rows = server.geocode_rows
+    calls = []
+
+    def fail_second_chunk(*args, **kwargs):
+        calls.append(None)
+        if len(calls) > 1:
+            raise RuntimeError("falha")
+        return geocode_rows(*args, **kwargs)
+
+    monkeypatch.setattr(server, "geocode_rows", fail_second_chunk)
+    monkeypatch.setattr(server, "RESPONSE_CHUNK_SIZE", 1)
+    rows = [{"COD": "137", "NUM": "20"}, {"COD": "250", "NUM": "5"}]
+    status, body = post(
+        f"{server_url}/geocode?code_col=COD&number_col=NUM",
+        json.dumps(rows),
+        "application/json",
+    )
+    assert status == 200
+    assert body.startswith("[{")
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(body)
+    calls.clear()
+    status, body = post(
+        f"{server_url}/geocode?code_col=COD&number_col=NUM",
+        "".join(json.dumps(row) + "\n" for row in rows),
+        "application/x-ndjson",
+    )
+    assert status == 200
+    assert len(body.splitlines()) == 1
+    assert json.loads(body)["LOG_NUMR"] == "End. oficial"
+
+
+def test_json_numbers_are_read_as_text(server_url):
+    status, body = post(
+        f"{server_url}/geocode?code_col=COD&number_col=NUM",
+        json.dumps([{"COD": 137, "NUM": 20.0}, {"COD": 137.0, "NUM": None}]),
+        "application/json",
+    )
+    records = json.loads(body)
+    assert status == 200
+    assert [record["NUM"] for record in records] == ["20", ""]
+    assert records[0]["LOG_NUMR"] == "End. oficial"
@@ -0,0 +1,27 @@
+import io
+import json
+
+from geocode import SearchMode
+from stream import stream_json
+
+
+def test_json_numbers_are_read_as_text(address_data):
+    address_index, street_matcher = address_data
+    output = io.StringIO()
+    stream_json(
+        address_index,
+        street_matcher,
+        io.StringIO(
+            '{"COD": 137, "NUM": 20.0}\n{"COD": 137.0, "NUM": 20}\n{"COD": null}\n'
+        ),
+        output,
+        {SearchMode.BY_CODE: "COD"},
+        "NUM",
+    )
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [record["LOG_NUMR"] for record in records] == [
+        "End. oficial",
+        "End. oficial",
+        "Não localizado",
+    ]
+    assert records[0]["NUM"] == 20.0
@@ -0,0 +1,32 @@
+import os
+import threading
+
+from util.street_matcher import MatchCache
+
+
+def test_concurrent_saves_leave_a_complete_file(tmp_path):
+    file = tmp_path / "cache.json"
+    caches = []
+    for i in range(8):
+        cache = MatchCache()
+        for j in range(2000):
+            cache.put(f"RUA {i} {j}", f"RUA {j}")
+        caches.append(cache)
+    errors = []
+
+    def save(cache: MatchCache) -> None:
+        try:
+            cache.save(file, "versao")
+        except OSError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=save, args=(cache,)) for cache in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    loaded = MatchCache()
+    loaded.load(file, "versao")
+    assert len(loaded._matches) == 2000
+    assert os.listdir(tmp_path) == ["cache.json"]
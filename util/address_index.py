@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from util.config import datatypes_dict
+
+INDEXED_COLUMNS = ("COD_LOGR", "CEP", "NOMELOGR")
+CEP_STREETS = "CEP_COD_LOGR"  # Streets within each CEP, as a CEP may span several
+SIDE_SCALE = 2**32  # Larger than any address number, used to build composite keys
+LAYOUT_FILE = "layout.json"  # Written last, so only complete versions are loaded
+LAYOUT_FORMAT = 2  # Changes when the files written by AddressIndex.save() do
+
+
+class AddressIndex:
+    """
+    Columnar view of the address database, grouped by street identifier.
+
+    For each indexed column, the row positions are sorted by (identifier, NUM_IMOV),
+    so every street becomes a contiguous slice that is found by a dict lookup
+    instead of a boolean scan of the whole table.
+
+    The rows of each CEP are also sorted by (COD_LOGR, NUM_IMOV) under the
+    CEP_STREETS key, whose groups are the streets of each CEP in turn.
+
+    The polygons of the areas (see util.area_index), when set as *areas*, are
+    used to place the addresses interpolated by the geocoder
+    """
+
+    def __init__(self, address_data: pd.DataFrame):
+        self.columns = {
+            col: address_data[col].to_numpy(dtype=object)
+            if address_data[col].dtype.kind not in "iuf"
+            else address_data[col].to_numpy()
+            for col in address_data.columns
+        }
+        self._orders = {}
+        self._bounds = {}
+        self._groups = {}
+        self._sides = {}
+        self._fingerprint = None
+        self.areas = None
+        address_numbers = self.columns["NUM_IMOV"]
+        for key in INDEXED_COLUMNS:
+            codes, uniques = pd.factorize(address_data[key], sort=True)
+            order = np.lexsort((address_numbers, codes))
+            self._orders[key] = order
+            self._bounds[key] = np.searchsorted(
+                codes[order], np.arange(len(uniques) + 1)
+            )
+            self._groups[key] = {value: g for g, value in enumerate(uniques.tolist())}
+            if key == "CEP":
+                cep_codes = codes
+
+        street_codes = self.columns["COD_LOGR"]
+        order = np.lexsort((address_numbers, street_codes, cep_codes))
+        ceps, streets = cep_codes[order], street_codes[order]
+        new_street = np.ones(len(order), dtype=bool)
+        new_street[1:] = (ceps[1:] != ceps[:-1]) | (streets[1:] != streets[:-1])
+        first_rows = np.flatnonzero(new_street)
+        self._orders[CEP_STREETS] = order
+        self._bounds[CEP_STREETS] = np.append(first_rows, len(order))
+        self._cep_streets = np.searchsorted(
+            ceps[first_rows], np.arange(len(self._groups["CEP"]) + 1)
+        )
+
+    def __len__(self) -> int:
+        return len(self.columns["NUM_IMOV"])
+
+    def rows(self, key: str, value) -> np.ndarray:
+        """
+        Positions of the rows where *key* equals *value*, sorted by NUM_IMOV
+        """
+        group = self._groups[key].get(value)
+        if group is None:
+            return self._orders[key][:0]
+        return self.group_rows(key, group)
+
+    def group_rows(self, key: str, group: int) -> np.ndarray:
+        """
+        Positions of the rows of a street number (see groups), sorted by NUM_IMOV
+        """
+        bounds = self._bounds[key]
+        return self._orders[key][bounds[group] : bounds[group + 1]]
+
+    def unique(self, key: str) -> list:
+        """
+        Sorted unique values of an indexed column
+        """
+        return list(self._groups[key].keys())
+
+    def groups(self, key: str, values) -> np.ndarray:
+        """
+        Street number (position in the sorted unique values) of each value,
+        or -1 if the value is not in the address database
+        """
+        groups = self._groups[key]
+        return np.array([groups.get(value, -1) for value in values], dtype=np.int64)
+
+    def cep_streets(self, groups: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Range of the CEP_STREETS groups (one per COD_LOGR) of each CEP group
+        """
+        return self._cep_streets[groups], self._cep_streets[groups + 1]
+
+    def sides(self, key: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Row positions sorted by (street, side of the street, NUM_IMOV) and their
+        sorted search keys (see side_keys), built on first use
+        """
+        if key not in self._sides:
+            order = self._orders[key]
+            street = np.repeat(
+                np.arange(len(self._bounds[key]) - 1), np.diff(self._bounds[key])
+            )
+            numbers = self.columns["NUM_IMOV"][order]
+            side_order = np.lexsort((numbers, numbers % 2, street))
+            self._sides[key] = (
+                order[side_order],
+                side_keys(street[side_order], numbers[side_order]),
+            )
+        return self._sides[key]
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of the address data, which identifies its version
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for col, values in self.columns.items():
+                digest.update(col.encode("utf-8"))
+                if values.dtype == object:
+                    digest.update("\n".join(map(str, values)).encode("utf-8"))
+                else:
+                    digest.update(np.ascontiguousarray(values).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def save(self, folder: Union[str, os.PathLike]) -> None:
+        """
+        Writes the columns and the street index as .npy files that load() maps to
+        memory. Each call writes a new version to its own subfolder and removes the
+        older ones, unless they are still mapped by another process
+        """
+        version = str(time.time_ns())
+        target = os.path.join(folder, version)
+        os.makedirs(target)
+        layout = {
+            "format": LAYOUT_FORMAT,
+            "version": version,
+            "fingerprint": self.fingerprint,
+            "columns": {},
+        }
+        arrays = {}
+        for col, values in self.columns.items():
+            if values.dtype == object:
+                codes, categories = pd.factorize(values, sort=True)
+                arrays[f"{col}.codes"] = codes.astype(np.int32)
+                arrays[f"{col}.categories"] = np.array(categories, dtype=str)
+                layout["columns"][col] = "category"
+            else:
+                arrays[col] = values
+                layout["columns"][col] = "numeric"
+        for key in INDEXED_COLUMNS:
+            arrays[f"{key}.values"] = np.array(self.unique(key))
+        for key in INDEXED_COLUMNS + (CEP_STREETS,):
+            arrays[f"{key}.order"] = self._orders[key]
+            arrays[f"{key}.bounds"] = self._bounds[key]
+            arrays[f"{key}.side_rows"], arrays[f"{key}.side_keys"] = self.sides(key)
+        arrays[f"{CEP_STREETS}.streets"] = self._cep_streets
+        for name, array in arrays.items():
+            np.save(os.path.join(target, f"{name}.npy"), array)
+        with open(os.path.join(target, LAYOUT_FILE), "w") as f:
+            json.dump(layout, f)
+        for entry in os.listdir(folder):
+            if entry != version:
+                shutil.rmtree(os.path.join(folder, entry), ignore_errors=True)
+
+    @classmethod
+    def load(cls, folder: Union[str, os.PathLike]) -> "AddressIndex":
+        """
+        Reads the latest version written by save(). Numeric columns and the street
+        index are memory-mapped, so their pages are shared by all the processes
+        using the same files, and only the text columns are decoded. Raises
+        ValueError if the files were written in another format
+        """
+        target = os.path.join(folder, latest_version(folder))
+        with open(os.path.join(target, LAYOUT_FILE), "r") as f:
+            layout = json.load(f)
+        if layout.get("format") != LAYOUT_FORMAT:
+            raise ValueError(f"Formato da cópia binária desatualizado: {target}")
+
+        def array(name: str) -> np.ndarray:
+            return np.load(os.path.join(target, f"{name}.npy"), mmap_mode="r")
+
+        address_index = cls.__new__(cls)
+        address_index.columns = {}
+        for col, kind in layout["columns"].items():
+            if kind == "category":
+                categories = array(f"{col}.categories").astype(object)
+                address_index.columns[col] = categories[array(f"{col}.codes")]
+            else:
+                address_index.columns[col] = array(col)
+        address_index._orders = {}
+        address_index._bounds = {}
+        address_index._groups = {}
+        address_index._sides = {}
+        address_index._fingerprint = layout.get("fingerprint")
+        address_index.areas = None
+        for key in INDEXED_COLUMNS:
+            address_index._groups[key] = {
+                value: g for g, value in enumerate(array(f"{key}.values").tolist())
+            }
+        for key in INDEXED_COLUMNS + (CEP_STREETS,):
+            address_index._orders[key] = array(f"{key}.order")
+            address_index._bounds[key] = array(f"{key}.bounds")
+            address_index._sides[key] = (
+                array(f"{key}.side_rows"),
+                array(f"{key}.side_keys"),
+            )
+        address_index._cep_streets = array(f"{CEP_STREETS}.streets")
+        return address_index
+
+
+def side_keys(groups: np.ndarray, numbers: np.ndarray) -> np.ndarray:
+    """
+    Composite keys that sort addresses by street, side of the street (even/odd)
+    and address number
+    """
+    numbers = np.minimum(numbers, SIDE_SCALE - 1)
+    return (groups * 2 + numbers % 2) * SIDE_SCALE + numbers
+
+
+def latest_version(folder: Union[str, os.PathLike]) -> Optional[str]:
+    """
+    Subfolder of the latest complete version written by AddressIndex.save()
+    """
+    if not os.path.isdir(folder):
+        return None
+    versions = [
+        entry
+        for entry in os.listdir(folder)
+        if entry.isdigit() and os.path.isfile(os.path.join(folder, entry, LAYOUT_FILE))
+    ]
+    return max(versions, key=int, default=None)
+
+
+def binary_folder(csv_file: Union[str, os.PathLike]) -> str:
+    """
+    Folder of the binary copy of an address database in CSV format
+    """
+    return os.path.splitext(csv_file)[0]
+
+
+def read_address_csv(csv_file: Union[str, os.PathLike]) -> pd.DataFrame:
+    return pd.read_csv(csv_file, sep=";", dtype=datatypes_dict())
+
+
+def load_address_index(csv_file: Union[str, os.PathLike]) -> AddressIndex:
+    """
+    Index of the address database, read from its binary copy when it is newer than
+    the CSV file. Otherwise the CSV file is parsed and the binary copy written again
+    """
+    folder = binary_folder(csv_file)
+    version = latest_version(folder)
+    if version is not None and os.path.getmtime(
+        os.path.join(folder, version, LAYOUT_FILE)
+    ) >= os.path.getmtime(csv_file):
+        try:
+            return AddressIndex.load(folder)
+        except ValueError:
+            pass
+    address_index = AddressIndex(read_address_csv(csv_file))
+    try:
+        address_index.save(folder)
+    except OSError:
+        pass
+    return address_index
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from util.address_index import LAYOUT_FILE, latest_version
+
+AREA_FORMAT = 1  # Changes when the files written by AreaIndex.save() do
+
+
+class AreaIndex:
+    """
+    Polygons of the area layers (AA and QT) and their attributes, to find the areas
+    that contain a batch of points.
+
+    The polygons of each layer are kept as shapely ragged arrays: a single array
+    of vertices, stored as float32 offsets from a common origin, and the offsets
+    of their rings and parts. These are the only arrays saved, memory-mapped and
+    pickled; the geometries are rebuilt from them, prepared and put in an STRtree
+    """
+
+    def __init__(self, layers: dict[str, tuple[np.ndarray, dict[str, np.ndarray]]]):
+        """
+        layers: polygons of each layer and their attribute columns
+        """
+        self._layers = {}
+        origins = []
+        for name, (polygons, columns) in layers.items():
+            valid = ~(shapely.is_missing(polygons) | shapely.is_empty(polygons))
+            geometry_type, coordinates, offsets = shapely.to_ragged_array(
+                polygons[valid], include_z=False
+            )
+            self._layers[name] = {
+                "type": int(geometry_type),
+                "coordinates": coordinates,
+                "offsets": list(offsets),
+                "columns": {col: values[valid] for col, values in columns.items()},
+            }
+            if len(coordinates):
+                origins.append(coordinates.min(axis=0))
+        self._origin = np.floor(np.min(origins, axis=0)) if origins else np.zeros(2)
+        for layer in self._layers.values():
+            layer["coordinates"] = (layer["coordinates"] - self._origin).astype(
+                np.float32
+            )
+        self._fingerprint = None
+        self._build()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_trees"]
+        del state["_polygons"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._build()
+
+    def _build(self) -> None:
+        self._polygons = {}
+        self._trees = {}
+        for name, layer in self._layers.items():
+            polygons = shapely.from_ragged_array(
+                shapely.GeometryType(layer["type"]),
+                layer["coordinates"].astype(np.float64) + self._origin,
+                tuple(layer["offsets"]),
+            )
+            shapely.prepare(polygons)
+            self._polygons[name] = polygons
+            self._trees[name] = shapely.STRtree(polygons)
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of the polygons and their attributes, which identifies their version
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1(self._origin.tobytes())
+            for name, layer in self._layers.items():
+                digest.update(name.encode("utf-8"))
+                for array in [layer["coordinates"]] + layer["offsets"]:
+                    digest.update(np.ascontiguousarray(array).tobytes())
+                for col, values in layer["columns"].items():
+                    digest.update(col.encode("utf-8"))
+                    digest.update("\n".join(map(str, values)).encode("utf-8"))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def lookup(self, x: np.ndarray, y: np.ndarray) -> dict[str, np.ndarray]:
+        """
+        Attributes (as text) of the first polygon of each layer that intersects
+        each point, or None where no polygon does
+        """
+        points = shapely.points(
+            np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        )
+        result = {}
+        for name, layer in self._layers.items():
+            # Candidates by bounding box, then tested against the prepared polygons
+            inputs, candidates = self._trees[name].query(points)
+            hit = shapely.intersects(self._polygons[name][candidates], points[inputs])
+            inputs, candidates = inputs[hit], candidates[hit]
+            order = np.lexsort((candidates, inputs))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = inputs[order][1:] != inputs[order][:-1]
+            order = order[first]
+            for col, values in layer["columns"].items():
+                result[col] = np.full(len(points), None, dtype=object)
+                result[col][inputs[order]] = values[candidates[order]].astype(str)
+        return result
+
+    def save(self, folder: Union[str, os.PathLike]) -> None:
+        """
+        Writes the polygons and attributes as .npy files that load() maps to memory,
+        to a new versioned subfolder as AddressIndex.save() does
+        """
+        version = str(time.time_ns())
+        target = os.path.join(folder, version)
+        os.makedirs(target)
+        layout = {
+            "format": AREA_FORMAT,
+            "version": version,
+            "fingerprint": self.fingerprint,
+            "origin": self._origin.tolist(),
+            "layers": {},
+        }
+        arrays = {}
+        for name, layer in self._layers.items():
+            layout["layers"][name] = {
+                "type": layer["type"],
+                "offsets": len(layer["offsets"]),
+                "columns": {},
+            }
+            arrays[f"{name}.coordinates"] = layer["coordinates"]
+            for level, offsets in enumerate(layer["offsets"]):
+                arrays[f"{name}.offsets{level}"] = offsets
+            for col, values in layer["columns"].items():
+                if values.dtype == object:
+                    codes, categories = pd.factorize(values, sort=True)
+                    arrays[f"{name}.{col}.codes"] = codes.astype(np.int32)
+                    arrays[f"{name}.{col}.categories"] = np.array(categories, dtype=str)
+                    layout["layers"][name]["columns"][col] = "category"
+                else:
+                    arrays[f"{name}.{col}"] = values
+                    layout["layers"][name]["columns"][col] = "numeric"
+        for array_name, array in arrays.items():
+            np.save(os.path.join(target, f"{array_name}.npy"), array)
+        with open(os.path.join(target, LAYOUT_FILE), "w") as f:
+            json.dump(layout, f)
+        for entry in os.listdir(folder):
+            if entry != version:
+                shutil.rmtree(os.path.join(folder, entry), ignore_errors=True)
+
+    @classmethod
+    def load(cls, folder: Union[str, os.PathLike]) -> "AreaIndex":
+        """
+        Reads the latest version written by save(). Raises ValueError if the files
+        were written in another format
+        """
+        target = os.path.join(folder, latest_version(folder))
+        with open(os.path.join(target, LAYOUT_FILE), "r") as f:
+            layout = json.load(f)
+        if layout.get("format") != AREA_FORMAT:
+            raise ValueError(f"Formato do índice de áreas desatualizado: {target}")
+
+        def array(name: str) -> np.ndarray:
+            return np.load(os.path.join(target, f"{name}.npy"), mmap_mode="r")
+
+        area_index = cls.__new__(cls)
+        area_index._layers = {}
+        area_index._origin = np.array(layout["origin"], dtype=np.float64)
+        area_index._fingerprint = layout.get("fingerprint")
+        for name, layer in layout["layers"].items():
+            columns = {}
+            for col, kind in layer["columns"].items():
+                if kind == "category":
+                    categories = array(f"{name}.{col}.categories").astype(object)
+                    columns[col] = categories[array(f"{name}.{col}.codes")]
+                else:
+                    columns[col] = array(f"{name}.{col}")
+            area_index._layers[name] = {
+                "type": layer["type"],
+                "coordinates": array(f"{name}.coordinates"),
+                "offsets": [
+                    array(f"{name}.offsets{level}") for level in range(layer["offsets"])
+                ],
+                "columns": columns,
+            }
+        area_index._build()
+        return area_index
+
+
+def load_area_index(folder: Union[str, os.PathLike]) -> Optional[AreaIndex]:
+    """
+    Area index saved by the last update of the geographic data, or None if there
+    is none in the current format
+    """
+    if latest_version(folder) is None:
+        return None
+    try:
+        return AreaIndex.load(folder)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,105 @@
+from typing import Optional
+
+import numpy as np
+import pyproj
+import shapely
+
+from util.address_index import AddressIndex
+
+ADDRESS_CRS = "EPSG:31983"  # SIRGAS 2000 / UTM 23S, the coordinates of the database
+QUERY_CHUNK_SIZE = 100000  # Points looked up in the tree at a time
+
+
+class CoordinateIndex:
+    """
+    Spatial index of the addresses by their X/Y coordinates, to find the address
+    nearest to any point.
+
+    Addresses sharing the same coordinates are indexed once, by their first row,
+    so the tree is built on the distinct positions only. Ties between positions at
+    the same distance go to the lowest row as well, which makes the results
+    independent of the order of the points and of the size of the chunks
+    """
+
+    def __init__(self, address_index: AddressIndex):
+        coordinates = np.column_stack(
+            (
+                np.asarray(address_index.columns["X"], dtype=np.float64),
+                np.asarray(address_index.columns["Y"], dtype=np.float64),
+            )
+        )
+        valid = np.flatnonzero(np.isfinite(coordinates).all(axis=1))
+        positions, first = np.unique(coordinates[valid], axis=0, return_index=True)
+        self._rows = valid[first]
+        self._tree = shapely.STRtree(shapely.points(positions))
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def nearest(
+        self, x: np.ndarray, y: np.ndarray, max_distance: Optional[float] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Row of the nearest address to each point and its distance in meters, or -1
+        and NaN for invalid coordinates and for points farther than max_distance
+        from every address
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        rows = np.full(len(x), -1, dtype=np.int64)
+        distances = np.full(len(x), np.nan)
+        valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        for start in range(0, len(valid), QUERY_CHUNK_SIZE):
+            chunk = valid[start : start + QUERY_CHUNK_SIZE]
+            (points, positions), chunk_distances = self._tree.query_nearest(
+                shapely.points(x[chunk], y[chunk]),
+                max_distance=max_distance,
+                return_distance=True,
+                all_matches=True,
+            )
+            # Ties are returned together, the lowest row of each point comes first
+            candidates = self._rows[positions]
+            order = np.lexsort((candidates, points))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = points[order][1:] != points[order][:-1]
+            order = order[first]
+            rows[chunk[points[order]]] = candidates[order]
+            distances[chunk[points[order]]] = chunk_distances[order]
+        return rows, distances
+
+
+def project_coordinates(
+    x: np.ndarray, y: np.ndarray, crs: Optional[str] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Coordinates in another reference system (such as "EPSG:4326" for GPS
+    longitude and latitude) converted to the one of the address database.
+    Raises ValueError if crs is not a known reference system
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if crs is None:
+        return x, y
+    try:
+        same_crs = pyproj.CRS.from_user_input(crs) == pyproj.CRS(ADDRESS_CRS)
+    except pyproj.exceptions.CRSError:
+        raise ValueError(f"Sistema de referência desconhecido: {crs}")
+    if same_crs:
+        return x, y
+    transformer = pyproj.Transformer.from_crs(crs, ADDRESS_CRS, always_xy=True)
+    return transformer.transform(x, y)
+
+
+def parse_coordinates(values: list[str]) -> np.ndarray:
+    """
+    Coordinates written as text, with a decimal point or comma, and NaN where
+    the text is not a number
+    """
+    return np.array([parse_coordinate(value) for value in values], dtype=np.float64)
+
+
+def parse_coordinate(text: str) -> float:
+    try:
+        return float(str(text).strip().replace(",", "."))
+    except ValueError:
+        return np.nan
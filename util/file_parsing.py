@@ -1,6 +1,7 @@
 import os
 import csv
-from typing import Union, Iterator
+import itertools
+from typing import Iterable, Iterator, TextIO, Union
 
 import pandas as pd
 import chardet
@@ -83,3 +84,51 @@ def file_streamer(file: Union[str, os.PathLike]) -> Iterator[dict[str, str]]:
     if file_extension.upper() == ".DBF":
         streamer = dbf_streamer
     return streamer(file)
+
+
+def chunk_streamer(
+    rows: Iterable[dict[str, str]], chunk_size: int
+) -> Iterator[list[dict[str, str]]]:
+    """
+    Groups a stream (or a list) of rows in lists of (at most) chunk_size rows
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class OrderedCsvWriter:
+    """
+    Writes chunks of rows to a CSV file in the order of their sequence numbers
+    (0, 1, 2...), whatever the order they are handed in. Chunks that arrive ahead
+    of their turn wait in a reorder buffer of at most max_pending chunks
+    """
+
+    def __init__(self, csvfile: TextIO, delimiter: str, max_pending: int = 16):
+        self.max_pending = max_pending
+        self._writer = csv.writer(csvfile, delimiter=delimiter)
+        self._pending = {}
+        self._next_sequence = 0
+
+    def buffered(self) -> int:
+        return len(self._pending)
+
+    def full(self, in_flight: int = 0) -> bool:
+        """
+        Whether the buffered chunks, plus in_flight chunks still being produced
+        (each of which may end up buffered), reach max_pending
+        """
+        return self.buffered() + in_flight >= self.max_pending
+
+    def write(self, sequence: int, rows: list[list[str]]) -> None:
+        if sequence != self._next_sequence and self.full():
+            raise BufferError(
+                f"Reorder buffer full while waiting for chunk {self._next_sequence}"
+            )
+        self._pending[sequence] = rows
+        while self._next_sequence in self._pending:
+            self._writer.writerows(self._pending.pop(self._next_sequence))
+            self._next_sequence += 1
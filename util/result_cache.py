@@ -0,0 +1,121 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Union
+
+SQLITE_TIMEOUT = 30  # Seconds to wait for other processes writing to the file
+SQLITE_MAX_PARAMETERS = 999  # Lowest limit of parameters per query of SQLite builds
+KEYS_PER_QUERY = (SQLITE_MAX_PARAMETERS - 1) // 3  # Keys looked up by each SELECT
+STALE_VERSION_AGE = 30 * 24 * 3600  # Seconds unused before a version is deleted
+
+# Connections inherited from a forked parent: never used, nor closed, by the child
+_inherited_connections = []
+
+
+class ResultCache:
+    """
+    Results of geocode() kept in a SQLite file across runs, keyed by search mode,
+    street identifier and address number (see geocode.lookup_key). Every entry is
+    tagged with the version of the address data it was computed for, so processes
+    running on different versions can share the file. The entries of versions
+    that were not used for STALE_VERSION_AGE are deleted when the file is opened.
+
+    Address numbers are stored as text, as they may not fit in a SQLite integer.
+    Each thread and each process opens its own connection to the file: those of
+    a forked parent are never reused
+    """
+
+    def __init__(self, file: Union[str, os.PathLike], version: str):
+        self.file = file
+        self.version = version
+        self._local = threading.local()
+        connection = self.connection()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (version TEXT, mode TEXT, "
+                "street TEXT, number TEXT, result TEXT, "
+                "PRIMARY KEY (version, mode, street, number))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS versions "
+                "(version TEXT PRIMARY KEY, last_used REAL)"
+            )
+            self._touch(connection)
+            connection.execute(
+                "DELETE FROM versions WHERE last_used < ?",
+                (time.time() - STALE_VERSION_AGE,),
+            )
+            connection.execute(
+                "DELETE FROM results WHERE version NOT IN (SELECT version FROM versions)"
+            )
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        # A connection must not cross a fork, such as that of the worker processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            if getattr(self._local, "connection", None) is not None:
+                _inherited_connections.append(self._local.connection)
+            connection = sqlite3.connect(self.file, timeout=SQLITE_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _touch(self, connection: sqlite3.Connection) -> None:
+        """
+        Marks the version as in use, so other processes keep its entries
+        """
+        connection.execute(
+            "INSERT OR REPLACE INTO versions VALUES (?, ?)", (self.version, time.time())
+        )
+
+    def get_many(
+        self, keys: Iterable[tuple[str, str, int]]
+    ) -> dict[tuple[str, str, int], dict[str, str]]:
+        """
+        Cached results of the keys found in the file
+        """
+        connection = self.connection()
+        keys = {(key[0], key[1], str(key[2])): key for key in keys}
+        text_keys = list(keys)
+        results = {}
+        for start in range(0, len(text_keys), KEYS_PER_QUERY):
+            chunk = text_keys[start : start + KEYS_PER_QUERY]
+            rows = connection.execute(
+                "SELECT mode, street, number, result FROM results "
+                "WHERE version = ? AND (mode, street, number) IN (VALUES "
+                + ", ".join(["(?, ?, ?)"] * len(chunk))
+                + ")",
+                [self.version] + [value for key in chunk for value in key],
+            )
+            for mode, street, number, result in rows:
+                results[keys[mode, street, number]] = json.loads(result)
+        return results
+
+    def put_many(self, results: dict[tuple[str, str, int], dict[str, str]]) -> None:
+        connection = self.connection()
+        with connection:
+            self._touch(connection)
+            connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        self.version,
+                        key[0],
+                        key[1],
+                        str(key[2]),
+                        json.dumps(result, ensure_ascii=False),
+                    )
+                    for key, result in results.items()
+                ],
+            )
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Optional, Union
+
+import numpy as np
+import rapidfuzz
+from thefuzz import fuzz, process, utils
+
+BATCH_CELLS = 2**24  # Size of each block of the score matrix in extract_many
+CACHE_SIZE = 100000
+
+
+def sort_key(street_name: str) -> str:
+    """
+    The string that fuzz.token_sort_ratio actually compares
+    """
+    return " ".join(sorted(utils.full_process(street_name, force_ascii=True).split()))
+
+
+def bigrams(text: str) -> set[str]:
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+class MatchCache:
+    """
+    Least recently used cache of fuzzy matches, keyed by standardized street name.
+    Names without a match are kept as well, with None as their value.
+    It may be shared by several threads
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE):
+        self.max_size = max_size
+        self._matches = OrderedDict()
+        self._lock = threading.Lock()
+        # Set to a dict to also collect the entries put from then on
+        self.added = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._matches)
+
+    def __contains__(self, street_name: str) -> bool:
+        return street_name in self._matches
+
+    def get(self, street_name: str) -> Optional[str]:
+        """
+        Cached match of a street name, or KeyError if it is not in the cache
+        """
+        with self._lock:
+            self._matches.move_to_end(street_name)
+            return self._matches[street_name]
+
+    def put(self, street_name: str, street_match: Optional[str]) -> None:
+        with self._lock:
+            self._matches[street_name] = street_match
+            self._matches.move_to_end(street_name)
+            if self.added is not None:
+                self.added[street_name] = street_match
+            while len(self._matches) > self.max_size:
+                self._matches.popitem(last=False)
+
+    def save(self, file: Union[str, os.PathLike], fingerprint: str) -> None:
+        """
+        Writes the cache to a JSON file, tagged with the fingerprint of the street
+        list it was built for
+        """
+        with self._lock:
+            matches = dict(self._matches)
+        # A temporary file of its own, as other processes may save the same cache
+        with tempfile.NamedTemporaryFile(
+            "w",
+            encoding="utf-8",
+            dir=os.path.dirname(os.path.abspath(file)),
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            json.dump({"fingerprint": fingerprint, "matches": matches}, f)
+        os.replace(f.name, file)
+
+    def load(self, file: Union[str, os.PathLike], fingerprint: str) -> None:
+        """
+        Reads back a cache saved with the same fingerprint, if there is one
+        """
+        try:
+            with open(file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if saved.get("fingerprint") != fingerprint:
+            return
+        for street_name, street_match in saved["matches"].items():
+            self.put(street_name, street_match)
+
+
+class StreetMatcher:
+    """
+    Fuzzy matching of street names against the standardized names in the address
+    database, with an inverted index of character bigrams to skip the names that
+    cannot reach the score cutoff.
+
+    The ratio behind token_sort_ratio is (L - D) / L, where L is the sum of the
+    lengths of both sort keys and D their insertion/deletion distance. Each edit
+    destroys at most 2 bigrams, so a name with a ratio above the cutoff shares at
+    least len(bigrams(query)) - 2 * D of them with the query. Names sharing less
+    than that are never scored, so results are the same as a full scan.
+    """
+
+    def __init__(
+        self,
+        street_list: list[str],
+        score_cutoff: int,
+        cache_file: Union[str, os.PathLike] = None,
+    ):
+        self.street_list = street_list
+        self.score_cutoff = score_cutoff
+        self.cache = MatchCache()
+        self.cache_file = cache_file
+        # Matches only depend on the street list and the cutoff
+        self.fingerprint = hashlib.sha1(
+            "\n".join([str(score_cutoff)] + street_list).encode("utf-8")
+        ).hexdigest()
+        if cache_file is not None:
+            self.cache.load(cache_file, self.fingerprint)
+        self._keys = [sort_key(street) for street in street_list]
+        self._lengths = np.array([len(key) for key in self._keys], dtype=np.int64)
+        postings = defaultdict(list)
+        for i, key in enumerate(self._keys):
+            for gram in bigrams(key):
+                postings[gram].append(i)
+        self._postings = {gram: np.array(ids) for gram, ids in postings.items()}
+
+    def candidates(self, query: str) -> np.ndarray:
+        """
+        Positions in street_list of the names that may score at least score_cutoff
+        """
+        # Scores are rounded to integers before they are compared to the cutoff
+        min_ratio = (self.score_cutoff - 0.5) / 100
+        key = sort_key(query)
+        grams = bigrams(key)
+        shared_grams = np.zeros(len(self.street_list), dtype=np.int64)
+        for gram in grams:
+            if gram in self._postings:
+                shared_grams[self._postings[gram]] += 1
+        max_distance = np.floor((1 - min_ratio) * (len(key) + self._lengths))
+        return np.flatnonzero(
+            (shared_grams >= len(grams) - 2 * max_distance)
+            & (np.abs(self._lengths - len(key)) <= max_distance)
+        )
+
+    def extract_one(self, query: str) -> Optional[tuple[str, int]]:
+        """
+        Same as process.extractOne(query, street_list) with token_sort_ratio
+        """
+        candidates = self.candidates(query)
+        if len(candidates) == 0:
+            choices = self.street_list
+        else:
+            choices = [self.street_list[i] for i in candidates]
+        return process.extractOne(
+            query,
+            choices,
+            scorer=fuzz.token_sort_ratio,
+            score_cutoff=self.score_cutoff,
+        )
+
+    def extract_many(self, queries: list[str]) -> list[Optional[tuple[str, int]]]:
+        """
+        Same as extract_one() for many queries. Every query is scored against every
+        name in a single matrix computed by rapidfuzz on all CPU cores, and only the
+        few names above the cutoff are then scored again by extractOne
+        """
+        results = []
+        batch_size = max(1, BATCH_CELLS // max(1, len(self.street_list)))
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start : start + batch_size]
+            # A point below the cutoff keeps the names whose score is rounded up to it
+            scores = rapidfuzz.process.cdist(
+                [sort_key(query) for query in batch],
+                self._keys,
+                scorer=rapidfuzz.fuzz.ratio,
+                score_cutoff=self.score_cutoff - 1,
+                dtype=np.uint8,
+                workers=-1,
+            )
+            for query, query_scores in zip(batch, scores):
+                candidates = np.flatnonzero(query_scores)
+                if len(candidates) == 0:
+                    results.append(None)
+                    continue
+                results.append(
+                    process.extractOne(
+                        query,
+                        [self.street_list[i] for i in candidates],
+                        scorer=fuzz.token_sort_ratio,
+                        score_cutoff=self.score_cutoff,
+                    )
+                )
+        return results
+
+    def match(self, query: str) -> Optional[str]:
+        """
+        Best match for a standardized street name, or None, going through the cache
+        """
+        try:
+            return self.cache.get(query)
+        except KeyError:
+            street_match = self.extract_one(query)
+            street_match = None if street_match is None else street_match[0]
+            self.cache.put(query, street_match)
+            return street_match
+
+    def match_many(self, queries: list[str]) -> None:
+        """
+        Matches all the standardized street names that are not cached yet in a
+        single batch, so the following calls to match() are cache hits
+        """
+        unmatched = [
+            query for query in dict.fromkeys(queries) if query not in self.cache
+        ]
+        for query, street_match in zip(unmatched, self.extract_many(unmatched)):
+            self.cache.put(query, None if street_match is None else street_match[0])
+
+    def save_cache(self) -> None:
+        if self.cache_file is not None:
+            self.cache.save(self.cache_file, self.fingerprint)
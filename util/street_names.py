@@ -1,4 +1,116 @@
 import unicodedata
+from functools import lru_cache
+
+import pandas as pd
+
+PREPOSITIONS = ("DE", "DO", "DA", "DOS", "DAS")
+STREET_TYPES = (
+    "ALAMEDA",
+    "ALA",
+    "AVENIDA",
+    "AVE",
+    "AV",
+    "BECO",
+    "BEC",
+    "PRACA",
+    "PCA",
+    "RODOVIA",
+    "ROD",
+    "RUA",
+    "R",
+    "TRAVESSA",
+    "TRV",
+)
+ABBREVIATIONS = {
+    "ALM": "ALMIRANTE",
+    "ARQ": "ARQUITETO",
+    "BRIG": "BRIGADEIRO",
+    "CB": "CABO",
+    "CPT": "CAPITAO",
+    "CAP": "CAPITAO",
+    "CAR": "CARDEAL",
+    "COM": "COMENDADOR",
+    "CON": "CONEGO",
+    "CONS": "CONSELHEIRO",
+    "CEL": "CORONEL",
+    "DEL": "DELEGADO",
+    "DEP": "DEPUTADO",
+    "DES": "DESEMBARGADOR",
+    "DET": "DETETIVE",
+    "DR": "DOUTOR",
+    "EMB": "EMBAIXADOR",
+    "ENG": "ENGENHEIRO",
+    "EXP": "EXPEDICIONARIO",
+    "FARM": "FARMACEUTICO",
+    "GEN": "GENERAL",
+    "GOV": "GOVERNADOR",
+    "JORN": "JORNALISTA",
+    "MJ": "MAJOR",
+    "MAR": "MARECHAL",
+    "MIN": "MINISTRO",
+    "MON": "MONSENHOR",
+    "NSA": "NOSSA",
+    "NSRA": "NOSSA SENHORA",
+    "PE": "PADRE",
+    "PRES": "PRESIDENTE",
+    "PROF": "PROFESSOR",
+    "RAD": "RADIALISTA",
+    "STA": "SANTA",
+    "STO": "SANTO",
+    "SGT": "SARGENTO",
+    "SEN": "SENADOR",
+    "SRA": "SENHORA",
+    "TEN": "TENENTE",
+    "VER": "VEREADOR",
+}
+UNIDADES = (
+    "ZERO",
+    "UM",
+    "DOIS",
+    "TRES",
+    "QUATRO",
+    "CINCO",
+    "SEIS",
+    "SETE",
+    "OITO",
+    "NOVE",
+)
+DEZENAS = (
+    "",
+    "DEZ",
+    "VINTE",
+    "TRINTA",
+    "QUARENTA",
+    "CINQUENTA",
+    "SESSENTA",
+    "SETENTA",
+    "OITENTA",
+    "NOVENTA",
+)
+DEZENAS_IRREGULARES = {
+    "11": "ONZE",
+    "12": "DOZE",
+    "13": "TREZE",
+    "14": "QUATORZE",
+    "15": "QUINZE",
+    "16": "DEZESSEIS",
+    "17": "DEZESSETE",
+    "18": "DEZOITO",
+    "19": "DEZENOVE",
+}
+CENTENAS = (
+    "",
+    "CENTO",
+    "DUZENTOS",
+    "TREZENTOS",
+    "QUATROCENTOS",
+    "QUINHENTOS",
+    "SEISCENTOS",
+    "SETECENTOS",
+    "OITOCENTOS",
+    "NOVECENTOS",
+)
+PUNCTUATION = str.maketrans("", "", ",.-'\"():;+/?$°@")
 
 
 def delete_prepositions(text):
@@ -8,8 +120,7 @@ def delete_prepositions(text):
     chunks = text.split()
     if len(chunks) == 0:
         return text
-    prep = ("DE", "DO", "DA", "DOS", "DAS")
-    for p in prep:
+    for p in PREPOSITIONS:
         while p in chunks:
             chunks.remove(p)
     return " ".join(chunks)
@@ -22,24 +133,7 @@ def delete_street_type(text):
     chunks = text.split()
     if len(chunks) == 0:
         return text
-    street_types = (
-        "ALAMEDA",
-        "ALA",
-        "AVENIDA",
-        "AVE",
-        "AV",
-        "BECO",
-        "BEC",
-        "PRACA",
-        "PCA",
-        "RODOVIA",
-        "ROD",
-        "RUA",
-        "R",
-        "TRAVESSA",
-        "TRV",
-    )
-    if chunks[0] in street_types:
+    if chunks[0] in STREET_TYPES:
         del chunks[0]
     return " ".join(chunks)
 
@@ -53,53 +147,12 @@ def expand_abreviations(text):
     chunks = text.split()
     if len(chunks) == 0:
         return text
-    abrev = {
-        "ALM": "ALMIRANTE",
-        "ARQ": "ARQUITETO",
-        "BRIG": "BRIGADEIRO",
-        "CB": "CABO",
-        "CPT": "CAPITAO",
-        "CAP": "CAPITAO",
-        "CAR": "CARDEAL",
-        "COM": "COMENDADOR",
-        "CON": "CONEGO",
-        "CONS": "CONSELHEIRO",
-        "CEL": "CORONEL",
-        "DEL": "DELEGADO",
-        "DEP": "DEPUTADO",
-        "DES": "DESEMBARGADOR",
-        "DET": "DETETIVE",
-        "DR": "DOUTOR",
-        "EMB": "EMBAIXADOR",
-        "ENG": "ENGENHEIRO",
-        "EXP": "EXPEDICIONARIO",
-        "FARM": "FARMACEUTICO",
-        "GEN": "GENERAL",
-        "GOV": "GOVERNADOR",
-        "JORN": "JORNALISTA",
-        "MJ": "MAJOR",
-        "MAR": "MARECHAL",
-        "MIN": "MINISTRO",
-        "MON": "MONSENHOR",
-        "NSA": "NOSSA",
-        "NSRA": "NOSSA SENHORA",
-        "PE": "PADRE",
-        "PRES": "PRESIDENTE",
-        "PROF": "PROFESSOR",
-        "RAD": "RADIALISTA",
-        "STA": "SANTA",
-        "STO": "SANTO",
-        "SGT": "SARGENTO",
-        "SEN": "SENADOR",
-        "SRA": "SENHORA",
-        "TEN": "TENENTE",
-        "VER": "VEREADOR",
-    }
-    if chunks[0] in abrev.keys():
-        chunks[0] = abrev[chunks[0]]
+    if chunks[0] in ABBREVIATIONS:
+        chunks[0] = ABBREVIATIONS[chunks[0]]
     return " ".join(chunks)
 
 
+@lru_cache(maxsize=2**16)
 def num_para_pt(num_str: str) -> str:
     """
     Converts digits to numbers expressed in the Portuguese language, as they are found in the address database
@@ -111,53 +164,6 @@ def num_para_pt(num_str: str) -> str:
             return num_str
     except:
         return num_str
-    unidades = (
-        "ZERO",
-        "UM",
-        "DOIS",
-        "TRES",
-        "QUATRO",
-        "CINCO",
-        "SEIS",
-        "SETE",
-        "OITO",
-        "NOVE",
-    )
-    dezenas = (
-        "",
-        "DEZ",
-        "VINTE",
-        "TRINTA",
-        "QUARENTA",
-        "CINQUENTA",
-        "SESSENTA",
-        "SETENTA",
-        "OITENTA",
-        "NOVENTA",
-    )
-    dezenas_irregulares = {
-        "11": "ONZE",
-        "12": "DOZE",
-        "13": "TREZE",
-        "14": "QUATORZE",
-        "15": "QUINZE",
-        "16": "DEZESSEIS",
-        "17": "DEZESSETE",
-        "18": "DEZOITO",
-        "19": "DEZENOVE",
-    }
-    centenas = (
-        "",
-        "CENTO",
-        "DUZENTOS",
-        "TREZENTOS",
-        "QUATROCENTOS",
-        "QUINHENTOS",
-        "SEISCENTOS",
-        "SETECENTOS",
-        "OITOCENTOS",
-        "NOVECENTOS",
-    )
     digito_milhares = num_str[:-3]
     digito_unidades = num_str[-3:]
     if len(num_str) > 3:
@@ -186,35 +192,62 @@ def num_para_pt(num_str: str) -> str:
             if int(digito_unidades) % 100 == 0:
                 if digito_unidades == "100":
                     return (resultado + "CEM").strip()
-                return (resultado + centenas[int(num_str[0])]).strip()
+                return (resultado + CENTENAS[int(num_str[0])]).strip()
             if num_str[-2] == "0":
                 sufixo_centena = ""
             else:
                 sufixo_centena = " E "
-            resultado = resultado + centenas[int(num_str[0])] + sufixo_centena
+            resultado = resultado + CENTENAS[int(num_str[0])] + sufixo_centena
         if len(num_str) > 1:
-            if num_str[-2:] in dezenas_irregulares.keys():
-                return (resultado + dezenas_irregulares[num_str[-2:]]).strip()
+            if num_str[-2:] in DEZENAS_IRREGULARES.keys():
+                return (resultado + DEZENAS_IRREGULARES[num_str[-2:]]).strip()
             elif int(num_str[-2:]) % 10 == 0:
-                return (resultado + dezenas[int(num_str[-2])]).strip()
-            resultado = resultado + dezenas[int(num_str[-2])] + " E "
-        resultado = resultado + unidades[int(num_str[-1])]
+                return (resultado + DEZENAS[int(num_str[-2])]).strip()
+            resultado = resultado + DEZENAS[int(num_str[-2])] + " E "
+        resultado = resultado + UNIDADES[int(num_str[-1])]
         return resultado.strip()
 
 
+class StreetNameNormalizer:
+    """
+    All the standardizations in this module in a single pass over the words of the
+    name, with the result memoized for each distinct name
+    """
+
+    def __init__(self, cache_size: int = 2**16):
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    @staticmethod
+    def _normalize(t: str) -> str:
+        t = t.strip().upper().translate(PUNCTUATION)  # Delete punctuations
+        t = "".join(
+            c
+            for c in unicodedata.normalize("NFD", t)
+            if unicodedata.category(c) != "Mn"
+        )  # Delete special characters
+        chunks = [c for c in t.split() if c not in PREPOSITIONS]
+        if len(chunks) > 0 and chunks[0] in STREET_TYPES:
+            del chunks[0]
+        if len(chunks) > 0 and chunks[0] in ABBREVIATIONS:
+            chunks[0] = ABBREVIATIONS[chunks[0]]
+        return " ".join(num_para_pt(c) if c.isdigit() else c for c in chunks)
+
+
+normalizer = StreetNameNormalizer()
+
+
 def standardize_street_names(t):
     """
     Apply all the standardizations in this module
     """
-    t = t.strip()
-    t = t.upper()
-    t = t.translate(str.maketrans("", "", ",.-'\"():;+/?$°@"))  # Delete punctuations
-    t = "".join(
-        c for c in unicodedata.normalize("NFD", t) if unicodedata.category(c) != "Mn"
-    )  # Delete special characters
-    t = delete_prepositions(t)
-    t = delete_street_type(t)
-    t = expand_abreviations(t)
-    chunks = t.split()
-    chunks = [num_para_pt(p) if p.isdigit() else p for p in chunks]
-    return " ".join(chunks)
+    return normalizer.normalize(t)
+
+
+def standardize_many(street_names: pd.Series) -> pd.Series:
+    """
+    Standardizes a Series of street names, normalizing each distinct name only once
+    """
+    unique_names = street_names.unique()
+    return street_names.map(
+        dict(zip(unique_names, map(standardize_street_names, unique_names)))
+    )
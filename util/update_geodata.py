@@ -1,41 +1,173 @@
 import gc
+import hashlib
+import importlib.util
+import json
 import os
 import requests
+import shutil
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import Union
+from typing import Optional, Union
+from xml.etree import ElementTree
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 import colorama as color
-from owslib.wfs import WebFeatureService
+from pandas.api.types import union_categoricals
+
+try:
+    import pyogrio
+except ImportError:  # Optional, reads shapefiles faster than Fiona
+    pyogrio = None
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, where memory is not reported
+    resource = None
 
 import util.config
 import util.cli as cli
-from util.street_names import standardize_street_names
+from util.address_index import (
+    AddressIndex,
+    binary_folder,
+    latest_version,
+    read_address_csv,
+)
+from util.area_index import AreaIndex
+from util.street_names import standardize_many
 
 ABSOLUTE_PATH = os.path.dirname(__file__)
 GEODATA_FOLDER = os.path.join(ABSOLUTE_PATH, "..", "geodata")
+STAGES_FOLDER = os.path.join(GEODATA_FOLDER, "etapas")
+STAGES_FILE = os.path.join(STAGES_FOLDER, "etapas.json")
+AREAS_FOLDER = os.path.join(GEODATA_FOLDER, "base_areas")
 SPINNER_STOP_SYMBOL = color.Fore.GREEN + "  v" + color.Fore.RESET
 
+DOWNLOAD_WORKERS = 4  # Layers and pages downloaded at the same time
+DOWNLOAD_RETRIES = 5
+RETRY_BACKOFF = 2  # Seconds before the first retry, doubled after each failure
+DOWNLOAD_TIMEOUT = 300
+DOWNLOAD_CHUNK_SIZE = 2**20
+# pyogrio reads through Arrow when it is available as well
+USE_ARROW = importlib.util.find_spec("pyarrow") is not None
+JOIN_CHUNK_SIZE = 100000  # Address points joined to the polygons at a time
+JOIN_WORKERS = 1  # Processes for the spatial joins, each with a copy of the polygons
+
 server_configuration = util.config.server()
 layer_configuration = util.config.layers()
 
+join_context = {}  # STRtree of the polygons in each process of a spatial join
 
-def update_shapefiles(
-    output_folder: Union[str, os.PathLike], layer_configuration
-) -> None:
+# Version of the way the stages are built, saved with their inputs: bump it
+# whenever build_addresses(), build_areas() or build_polygons() change, so that
+# the stages saved by the previous code are built again
+STAGES_VERSION = 1
+
+# Layers each stage of the update depends on
+stage_layers = {
+    "enderecos": ["END"],
+    "areas_abrangencia": ["END", "AA"],
+    "quarteiroes": ["END", "QT"],
+    "poligonos": ["AA", "QT"],
+}
+
+
+class WFSError(requests.exceptions.RequestException):
+    """
+    Exception report sent by the WFS server instead of the requested data
+    """
+
+
+def with_retries(function, *args):
     """
-    Downloads shapefiles from a WFS server
+    Calls the function until it succeeds, waiting longer after each failed request
     """
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            return function(*args)
+        except requests.exceptions.RequestException:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            time.sleep(RETRY_BACKOFF * 2**attempt)
 
-    wfs = WebFeatureService(
-        url=server_configuration["wfs_server"],
-        version=server_configuration["wfs_version"],
-        timeout=300,
+
+def wfs_parameters(server: dict, wfs_layer: str, **parameters) -> dict:
+    return {
+        "service": "WFS",
+        "version": server["wfs_version"],
+        "request": "GetFeature",
+        "typeName": wfs_layer,
+        **parameters,
+    }
+
+
+def count_features(server: dict, wfs_layer: str) -> int:
+    response = requests.get(
+        server["wfs_server"],
+        params=wfs_parameters(server, wfs_layer, resultType="hits"),
+        timeout=DOWNLOAD_TIMEOUT,
     )
+    response.raise_for_status()
+    try:
+        attributes = ElementTree.fromstring(response.content).attrib
+        return int(attributes.get("numberMatched", attributes.get("numberOfFeatures")))
+    except (ElementTree.ParseError, TypeError, ValueError):
+        raise WFSError(f"Resposta inválida do servidor WFS para {wfs_layer}")
+
+
+def download_file(server: dict, parameters: dict, output_file: str) -> None:
+    """
+    Streams a GetFeature response to a temporary file, renamed to output_file only
+    once it is complete
+    """
+    temp_file = f"{output_file}.part"
+    with requests.get(
+        server["wfs_server"], params=parameters, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        if "xml" in response.headers.get("Content-Type", ""):
+            raise WFSError(response.text)
+        with open(temp_file, "wb") as w:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                w.write(chunk)
+    os.replace(temp_file, output_file)
+
+
+def merge_pages(pages: list[str], output_file: str) -> None:
+    """
+    Copies the shapefiles of every page to a single zip file, one layer per page,
+    without decoding them
+    """
+    temp_file = f"{output_file}.part"
+    with zipfile.ZipFile(temp_file, "w", zipfile.ZIP_DEFLATED) as merged:
+        for number, page in enumerate(pages):
+            with zipfile.ZipFile(page) as z:
+                for member in z.namelist():
+                    name, extension = os.path.splitext(member)
+                    with z.open(member) as r, merged.open(
+                        f"{name}_{number:04d}{extension}", "w"
+                    ) as w:
+                        shutil.copyfileobj(r, w, DOWNLOAD_CHUNK_SIZE)
+    os.replace(temp_file, output_file)
 
-    def save_file(
-        filename: str, wfs_layer: str, output_folder: Union[str, os.PathLike]
-    ) -> None:
+
+def update_shapefiles(
+    output_folder: Union[str, os.PathLike],
+    layer_configuration,
+    server_configuration: dict = server_configuration,
+) -> None:
+    """
+    Downloads shapefiles from a WFS server, all at the same time. Layers with a
+    page size ("pagina") are downloaded in pages that are kept until the whole
+    layer is complete, so an interrupted download resumes where it stopped
+    """
+
+    def confirm_update(filename: str, output_folder: Union[str, os.PathLike]) -> bool:
         output_file = os.path.join(output_folder, filename)
         if os.path.isfile(output_file):
             mod_date = datetime.utcfromtimestamp(
@@ -57,14 +189,95 @@ def update_shapefiles(
                     + color.Style.BRIGHT
                     + f"{filename[:-4]}\n"
                 )
-                return
+                return False
+        return True
 
-        sp = cli.spinner(f"Baixando camada {filename[:-4]}")
-        sp.start()
-        response = wfs.getfeature(typename=wfs_layer, outputFormat="shape-zip")
-        with open(output_file, "wb") as w:
-            w.write(bytes(response.read()))
-        sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+    layers = [
+        layer
+        for layer in layer_configuration.values()
+        if confirm_update(layer["arquivo"], output_folder)
+    ]
+    if not layers:
+        return
+
+    sp = cli.spinner(
+        "Baixando camadas " + ", ".join(layer["arquivo"][:-4] for layer in layers)
+    )
+    sp.start()
+    # WFS 1.x limits the number of features with maxFeatures, 2.0 with count
+    if server_configuration["wfs_version"].startswith("1."):
+        count_parameter = "maxFeatures"
+    else:
+        count_parameter = "count"
+    downloads = []
+    errors = {}
+    layer_files = {}
+    for layer in layers:
+        output_file = os.path.join(output_folder, layer["arquivo"])
+        parameters = wfs_parameters(
+            server_configuration, layer["camada_wfs"], outputFormat="shape-zip"
+        )
+        page_size = layer.get("pagina")
+        if page_size is None:
+            layer_files[output_file] = [output_file]
+            downloads.append((parameters, output_file))
+            continue
+        try:
+            total = with_retries(
+                count_features, server_configuration, layer["camada_wfs"]
+            )
+        except requests.exceptions.RequestException as error:
+            layer_files[output_file] = [output_file]
+            errors[output_file] = error
+            continue
+        pages_folder = f"{output_file}.paginas"
+        os.makedirs(pages_folder, exist_ok=True)
+        layer_files[output_file] = []
+        for start in range(0, max(total, 1), page_size):
+            # Pages are named after the total, so a layer that changed in the
+            # meantime is downloaded again
+            page = os.path.join(pages_folder, f"{total}_{start}.zip")
+            layer_files[output_file].append(page)
+            if not os.path.isfile(page):
+                page_parameters = {
+                    **parameters,
+                    "startIndex": start,
+                    count_parameter: page_size,
+                }
+                downloads.append((page_parameters, page))
+
+    with ThreadPoolExecutor(DOWNLOAD_WORKERS) as executor:
+        futures = {
+            file: executor.submit(
+                with_retries, download_file, server_configuration, parameters, file
+            )
+            for parameters, file in downloads
+        }
+    for file, future in futures.items():
+        if future.exception() is not None:
+            errors[file] = future.exception()
+
+    failures = []
+    for output_file, files in layer_files.items():
+        failed = [errors[file] for file in files if file in errors]
+        if failed:
+            failures.append((output_file, failed[0]))
+        elif files != [output_file]:
+            merge_pages(files, output_file)
+            shutil.rmtree(f"{output_file}.paginas", ignore_errors=True)
+    sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+
+    failed_files = [output_file for output_file, _ in failures]
+    for output_file in layer_files:
+        filename = os.path.basename(output_file)
+        if output_file in failed_files:
+            print(
+                color.Fore.RED
+                + "Falha ao baixar a camada "
+                + color.Style.BRIGHT
+                + f"{filename[:-4]}\n"
+            )
+            continue
         print(
             color.Fore.GREEN
             + "Camada "
@@ -75,110 +288,303 @@ def update_shapefiles(
             + color.Style.NORMAL
             + " atualizada com sucesso\n"
         )
+    if failures:
+        raise failures[0][1]
 
-    for layer in layer_configuration.values():
-        save_file(layer["arquivo"], layer["camada_wfs"], output_folder)
+
+def shapefile_layers(file) -> list[str]:
+    """
+    Names of the shapefiles in a zip file (several for layers downloaded in pages)
+    """
+    with zipfile.ZipFile(file) as z:
+        return [
+            os.path.splitext(os.path.basename(member))[0]
+            for member in z.namelist()
+            if member.lower().endswith(".shp")
+        ]
+
+
+def layer_columns(file, layer: str) -> list[str]:
+    """
+    Attribute columns of a shapefile, read from its schema without its features
+    """
+    if pyogrio is not None:
+        return list(pyogrio.read_info(file, layer=layer)["fields"])
+    # Fiona stops reading after the requested number of features
+    return list(gpd.read_file(file, layer=layer, rows=0).columns.drop("geometry"))
+
+
+def read_layer(file, layer: str, include_cols: list[str], exclude_cols: list[str]):
+    if pyogrio is not None:
+        return gpd.read_file(
+            file,
+            layer=layer,
+            engine="pyogrio",
+            columns=include_cols,
+            use_arrow=USE_ARROW,
+        )
+    return gpd.read_file(file, layer=layer, ignore_fields=exclude_cols)
+
+
+def compact_column(column: pd.Series, datatype: str) -> pd.Series:
+    """
+    Column in the smallest dtype for its datatype in geodata.yaml, keeping nulls
+    """
+    if datatype == "category":
+        return column.astype("category")
+    if datatype == "int":
+        if not pd.api.types.is_numeric_dtype(column):
+            # Integer fields stored as text
+            column = pd.to_numeric(column)
+        try:
+            return column.astype("Int32")
+        except (TypeError, ValueError):
+            return column.astype("Int64")
+    return column
+
+
+def reset_peak_memory() -> bool:
+    """
+    Resets the peak resident memory of the process to its current size, so that
+    peak_memory() reports the peak from now on. Only possible on Linux
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory() -> Optional[int]:
+    """
+    Peak resident memory of the process (since reset_peak_memory(), if it was
+    reset), in bytes, which includes the buffers of GDAL and Arrow. None where
+    it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes, except on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
 
 
 def gdf_loader(file, cols_dict):
     """
-    Presets for the "read_file" method in the GeoPandas module,
-    with the option to specify the columns to be INCLUDED
+    Presets for the "read_file" method in the GeoPandas module, reading only the
+    columns to be INCLUDED, in compact dtypes, and reporting the time it took and
+    the peak memory of the process while it was loaded (see peak_memory)
     """
     include_cols = [c["nome_original"] for c in cols_dict]
-    sp = cli.spinner(
-        f"Carregando camada {os.path.basename(file)[:-4]} do disco para a memória"
-    )
+    layer_name = os.path.basename(file)[:-4]
+    sp = cli.spinner(f"Carregando camada {layer_name} do disco para a memória")
     sp.start()
-    gdf_sample = gpd.read_file(file, rows=1)
-    all_cols = list(gdf_sample.columns)
-    include_cols.append("geometry")
+    layers = shapefile_layers(file)
+    all_cols = layer_columns(file, layers[0])
     for col in include_cols:
         if col not in all_cols:
             raise KeyError(
                 f"Coluna *{col}* não encontrada em {os.path.basename(file)}. Checar possível mudança de nomenclatura."
             )
     exclude_cols = [c for c in all_cols if c not in include_cols]
-    gdf = gpd.read_file(file, ignore_fields=exclude_cols)
-    sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+
+    # Without a reset, the peak is only known if the layer raised it
+    reset = reset_peak_memory()
+    start_peak = peak_memory()
+    start_time = time.perf_counter()
+    # Each page is converted before the next one is read
+    pages = []
+    for layer in layers:
+        page = read_layer(file, layer, include_cols, exclude_cols)
+        for c in cols_dict:
+            col = c["nome_original"]
+            page[col] = compact_column(page[col], c["datatype"])
+        pages.append(page)
+    if len(pages) == 1:
+        gdf = pages[0]
+    else:
+        # Categorical columns are only concatenated as such with equal categories
+        for c in cols_dict:
+            if c["datatype"] == "category":
+                col = c["nome_original"]
+                categories = union_categoricals([page[col] for page in pages])
+                for page in pages:
+                    page[col] = page[col].cat.set_categories(categories.categories)
+        gdf = pd.concat(pages, ignore_index=True)
+        del [[pages]]
+    text = f"Camada {layer_name} carregada em {time.perf_counter() - start_time:.1f} s"
+    peak = peak_memory()
+    if peak is not None and (reset or peak > start_peak):
+        text += f" (pico de {peak / 2**20:.0f} MB no processo)"
+    sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL, text=text)
     return gdf
 
 
-def spatial_join(gdf_points, gdf_polygons, text=""):
+def polygon_tree(polygons: np.ndarray) -> shapely.STRtree:
+    shapely.prepare(polygons)
+    return shapely.STRtree(polygons)
+
+
+def start_join_worker(polygons: np.ndarray) -> None:
+    join_context["tree"] = polygon_tree(shapely.from_wkb(polygons))
+
+
+def join_chunk(points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
     """
-    Presets for the "sjoin" method in the GeoPandas module
+    Positions of the points and of the polygons that intersect them, sorted
+    """
+    point_rows, polygon_rows = join_context["tree"].query(
+        points, predicate="intersects"
+    )
+    order = np.lexsort((polygon_rows, point_rows))
+    return point_rows[order], polygon_rows[order]
+
+
+def join_coordinates(coordinates: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    return join_chunk(shapely.points(coordinates))
+
+
+def spatial_join(gdf_points, gdf_polygons, text="", workers=JOIN_WORKERS):
+    """
+    Attributes of the polygons that intersect each point, indexed by the index of
+    the points: the same pairs as an inner "sjoin" in the GeoPandas module,
+    sorted by point and then by polygon.
+    The points are queried in chunks against a single STRtree of the polygons,
+    optionally on several processes, so no joined GeoDataFrame is built
     """
     sp = cli.spinner(text)
     sp.start()
-    gdf = gpd.sjoin(
-        gdf_points,
-        gdf_polygons,
-        how="inner",
+    polygons = np.asarray(gdf_polygons.geometry.values)
+    points = np.asarray(gdf_points.geometry.values)
+    starts = range(0, len(points), JOIN_CHUNK_SIZE)
+    if workers > 1:
+        # Polygons are sent to other processes as WKB and points as coordinates,
+        # which is much faster than pickling shapely objects
+        results = []
+        with ProcessPoolExecutor(
+            workers,
+            initializer=start_join_worker,
+            initargs=(shapely.to_wkb(polygons),),
+        ) as executor:
+            # Only a few chunks are sent ahead, so they are not all copied at once
+            running = []
+            for start in starts:
+                if len(running) >= 2 * workers:
+                    results.append(running.pop(0).result())
+                chunk = shapely.get_coordinates(points[start : start + JOIN_CHUNK_SIZE])
+                running.append(executor.submit(join_coordinates, chunk))
+            results.extend(future.result() for future in running)
+    else:
+        join_context["tree"] = polygon_tree(polygons)
+        results = [
+            join_chunk(points[start : start + JOIN_CHUNK_SIZE]) for start in starts
+        ]
+        join_context.clear()
+
+    no_rows = np.empty(0, dtype=np.int64)
+    point_rows = np.concatenate(
+        [no_rows] + [start + rows for start, (rows, _) in zip(starts, results)]
     )
-    gdf.dropna(how="any", inplace=True)
+    polygon_rows = np.concatenate([no_rows] + [rows for _, rows in results])
+    attributes = pd.DataFrame(gdf_polygons.drop(columns="geometry")).iloc[polygon_rows]
+    attributes.index = gdf_points.index[point_rows]
+    attributes = attributes.dropna(how="any")
     sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
-    return gdf
+    return attributes
 
 
-def update_all() -> None:
+def layer_fingerprint(layer_name: str) -> str:
     """
-    Main function
+    Hash of a downloaded layer and of its settings in geodata.yaml
     """
-    if not os.path.exists(GEODATA_FOLDER):
-        os.makedirs(GEODATA_FOLDER)
+    layer = layer_configuration[layer_name]
+    digest = hashlib.sha1(json.dumps(layer, sort_keys=True).encode("utf-8"))
+    with open(os.path.join(GEODATA_FOLDER, layer["arquivo"]), "rb") as r:
+        for chunk in iter(lambda: r.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    os.system("cls" if os.name == "nt" else "clear")
-    color.init(autoreset=True)
-    cli.print_title("DOWNLOAD DE CAMADAS DO SERVIDOR WFS")
 
+def column_names(layer_name: str) -> dict[str, str]:
+    return {
+        c["nome_original"]: c["renomear_para"]
+        for c in layer_configuration[layer_name]["colunas"]
+    }
+
+
+def convert_datatypes(gdf, layer_name: str) -> None:
+    for c in layer_configuration[layer_name]["colunas"]:
+        if c["datatype"] != "str":
+            gdf[c["renomear_para"]] = gdf[c["renomear_para"]].astype(c["datatype"])
+
+
+def saved_stages() -> dict:
+    """
+    Inputs (see stage_inputs) each saved stage was built from
+    """
     try:
-        update_shapefiles(GEODATA_FOLDER, layer_configuration)
-    except requests.exceptions.Timeout:
-        print(
-            color.Fore.RED
-            + "Falha de conexão com o servidor WFS. Tente novamente mais tarde."
-        )
+        with open(STAGES_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    cli.print_title("PROCESSAMENTO DOS DADOS GEOGRÁFICOS")
 
-    # Links addresses to areas
-    aa = gdf_loader(
-        file=os.path.join(GEODATA_FOLDER, layer_configuration["AA"]["arquivo"]),
-        cols_dict=layer_configuration["AA"]["colunas"],
-    )
-    end_raw = gdf_loader(
-        file=os.path.join(GEODATA_FOLDER, layer_configuration["END"]["arquivo"]),
-        cols_dict=layer_configuration["END"]["colunas"],
-    )
-    end_aa = spatial_join(end_raw, aa, f"Associando endereços a áreas de abrangência")
-    del [[end_raw, aa]]
-    gc.collect()
-    end_aa.drop(["index_right"], axis=1, inplace=True)
+def stage_inputs(name: str, fingerprints: dict) -> dict:
+    """
+    What the product of a stage depends on: the fingerprints of its layers and
+    the version of the code that builds it
+    """
+    inputs = {layer_name: fingerprints[layer_name] for layer_name in stage_layers[name]}
+    inputs["versao"] = STAGES_VERSION
+    return inputs
 
-    # Links addresses to city blocks
-    qt = gdf_loader(
-        file=os.path.join(GEODATA_FOLDER, layer_configuration["QT"]["arquivo"]),
-        cols_dict=layer_configuration["QT"]["colunas"],
-    )
-    end = spatial_join(end_aa, qt, f"Associando endereços a quarteirões")
-    del [[end_aa, qt]]
-    gc.collect()
-    end.drop(["index_right"], axis=1, inplace=True)
 
-    # Rearrange data
-    end = end.loc[:, util.config.old_col_names()]
-    end.columns = util.config.new_col_names()
+def stage_is_current(name: str, fingerprints: dict) -> bool:
+    stage_file = os.path.join(STAGES_FOLDER, f"{name}.pkl")
+    inputs = stage_inputs(name, fingerprints)
+    return saved_stages().get(name) == inputs and os.path.isfile(stage_file)
 
-    # Drop empty values or duplicates
+
+def run_stage(name: str, fingerprints: dict, build):
+    """
+    Product of a stage of the update, saved to STAGES_FOLDER. It is read back
+    instead of built again while the layers it depends on and the code that
+    builds it (STAGES_VERSION) are unchanged
+    """
+    stage_file = os.path.join(STAGES_FOLDER, f"{name}.pkl")
+    if stage_is_current(name, fingerprints):
+        sp = cli.spinner(f"Reaproveitando etapa {name} (camadas inalteradas)")
+        sp.start()
+        product = pd.read_pickle(stage_file)
+        sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+        return product
+
+    product = build()
+    pd.to_pickle(product, f"{stage_file}.tmp")
+    os.replace(f"{stage_file}.tmp", stage_file)
+    stages = saved_stages()
+    stages[name] = stage_inputs(name, fingerprints)
+    with open(f"{STAGES_FILE}.tmp", "w") as f:
+        json.dump(stages, f)
+    os.replace(f"{STAGES_FILE}.tmp", STAGES_FILE)
+    return product
+
+
+def build_addresses() -> gpd.GeoDataFrame:
+    """
+    Address points with their own attributes, which only depend on the END layer
+    """
+    end = gdf_loader(
+        file=os.path.join(GEODATA_FOLDER, layer_configuration["END"]["arquivo"]),
+        cols_dict=layer_configuration["END"]["colunas"],
+    )
+    end.rename(columns=column_names("END"), inplace=True)
     end.dropna(how="any", inplace=True)
-    end.drop_duplicates(subset=["COD_LOGR", "NUM_IMOV"], inplace=True)
 
     # Convert datatypes
     sp = cli.spinner("Convertendo dados")
     sp.start()
-    for col, datatype in zip(util.config.new_col_names(), util.config.datatypes_list()):
-        if datatype != "str":
-            end[col] = end[col].astype(datatype)
+    convert_datatypes(end, "END")
     sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
 
     # Cast coordinates to text columns
@@ -186,29 +592,154 @@ def update_all() -> None:
     sp.start()
     end["X"] = end["geometry"].x.round(0).astype(int)
     end["Y"] = end["geometry"].y.round(0).astype(int)
-    end.drop(["geometry"], axis=1, inplace=True)
     sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
 
     # Standardization of street names
     sp = cli.spinner("Padronizando nomes de logradouros")
     sp.start()
-    end["NOMELOGR"] = end.apply(
-        lambda row: standardize_street_names(row["NOMELOGR"]), axis=1
-    )
+    end["NOMELOGR"] = standardize_many(end["NOMELOGR"])
     sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
 
+    end.reset_index(drop=True, inplace=True)
+    return end
+
+
+def build_areas(addresses: gpd.GeoDataFrame, layer_name: str, text: str):
+    """
+    Attributes of the polygons of a layer that contain each address, indexed by
+    the position of the address in build_addresses()
+    """
+    polygons = gdf_loader(
+        file=os.path.join(GEODATA_FOLDER, layer_configuration[layer_name]["arquivo"]),
+        cols_dict=layer_configuration[layer_name]["colunas"],
+    )
+    areas = spatial_join(addresses, polygons, text)
+    del [[polygons]]
+    gc.collect()
+    areas.rename(columns=column_names(layer_name), inplace=True)
+    convert_datatypes(areas, layer_name)
+    return areas
+
+
+def build_polygons() -> AreaIndex:
+    """
+    Polygons of the area layers with their attributes, kept by the geocoder to
+    place the interpolated addresses
+    """
+    sp = cli.spinner("Preparando índice dos polígonos de áreas")
+    layers = {}
+    for layer_name in stage_layers["poligonos"]:
+        polygons = gdf_loader(
+            file=os.path.join(
+                GEODATA_FOLDER, layer_configuration[layer_name]["arquivo"]
+            ),
+            cols_dict=layer_configuration[layer_name]["colunas"],
+        )
+        sp.start()
+        polygons.rename(columns=column_names(layer_name), inplace=True)
+        polygons.dropna(how="any", inplace=True)
+        convert_datatypes(polygons, layer_name)
+        layers[layer_name] = (
+            np.asarray(polygons.geometry.values),
+            {
+                col: polygons[col].to_numpy()
+                for col in column_names(layer_name).values()
+            },
+        )
+        sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+        del [[polygons]]
+        gc.collect()
+    return AreaIndex(layers)
+
+
+def update_all() -> None:
+    """
+    Main function
+    """
+    if not os.path.exists(GEODATA_FOLDER):
+        os.makedirs(GEODATA_FOLDER)
+    if not os.path.exists(STAGES_FOLDER):
+        os.makedirs(STAGES_FOLDER)
+
+    os.system("cls" if os.name == "nt" else "clear")
+    color.init(autoreset=True)
+    cli.print_title("DOWNLOAD DE CAMADAS DO SERVIDOR WFS")
+
+    try:
+        update_shapefiles(GEODATA_FOLDER, layer_configuration)
+    except requests.exceptions.RequestException:
+        print(
+            color.Fore.RED
+            + "Falha de conexão com o servidor WFS. Tente novamente mais tarde."
+        )
+
+    cli.print_title("PROCESSAMENTO DOS DADOS GEOGRÁFICOS")
+
+    # Only the stages downstream of a changed layer are run again
+    fingerprints = {
+        layer_name: layer_fingerprint(layer_name) for layer_name in layer_configuration
+    }
+    csv_file = os.path.join(GEODATA_FOLDER, "base_enderecos.csv")
+    if (
+        os.path.isfile(csv_file)
+        and latest_version(AREAS_FOLDER) is not None
+        and all(stage_is_current(name, fingerprints) for name in stage_layers)
+    ):
+        print(
+            color.Fore.GREEN
+            + "Nenhuma camada foi alterada desde a última atualização\n"
+        )
+        color.deinit()
+        input("\nPressione <ENTER> para retornar ao menu inicial...")
+        return
+
+    addresses = run_stage("enderecos", fingerprints, build_addresses)
+    # Links addresses to areas
+    aa = run_stage(
+        "areas_abrangencia",
+        fingerprints,
+        lambda: build_areas(
+            addresses, "AA", "Associando endereços a áreas de abrangência"
+        ),
+    )
+    # Links addresses to city blocks
+    qt = run_stage(
+        "quarteiroes",
+        fingerprints,
+        lambda: build_areas(addresses, "QT", "Associando endereços a quarteirões"),
+    )
+    # Polygons that place the interpolated addresses when geocoding
+    areas = run_stage("poligonos", fingerprints, build_polygons)
+
+    # Rearrange data
+    end = pd.DataFrame(addresses.drop(["geometry"], axis=1))
+    del [[addresses]]
+    gc.collect()
+    end = end.join(aa, how="inner").join(qt, how="inner")
+    end = end.loc[:, util.config.new_col_names()[:-1] + ["X", "Y"]]
+
+    # Drop duplicates
+    end.drop_duplicates(subset=["COD_LOGR", "NUM_IMOV"], inplace=True)
+
     # Sort data and save to CSV
     sp = cli.spinner("Salvando base de endereços processada")
     sp.start()
     end.sort_values(by=["COD_LOGR", "NUM_IMOV"], inplace=True)
     end.reset_index(drop=True, inplace=True)
-    end.to_csv(os.path.join(GEODATA_FOLDER, "base_enderecos.csv"), index=False, sep=";")
+    end.to_csv(csv_file, index=False, sep=";")
     sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
 
     # Try to clean memory
     del [[end]]
     gc.collect()
 
+    # Binary copy of the CSV file, which is much faster to load
+    sp = cli.spinner("Salvando cópia binária da base de endereços")
+    sp.start()
+    AddressIndex(read_address_csv(csv_file)).save(binary_folder(csv_file))
+    areas.save(AREAS_FOLDER)
+    sp.stop_and_persist(symbol=SPINNER_STOP_SYMBOL)
+
     print(
         color.Fore.GREEN
         + color.Style.BRIGHT